@@ -0,0 +1,127 @@
+from collections import deque
+import asyncio
+
+
+# Concurrency limit of one host and connection pool, raised while the requests are healthy and cut
+# when they degrade (additive increase / multiplicative decrease, doubling until the first cut like
+# tcp slow start). Health is judged per window of completed requests from the p95 latency and the
+# error rate. Pages and images of a host have separate limits, their latencies are not comparable.
+class HostLimit:
+
+    def __init__(self, limiter, host, pool_name):
+        self.limiter = limiter
+        self.host = host
+        self.pool_name = pool_name
+        self.limit = limiter.initial_limit
+        self.max_limit = limiter.max_limits.get(pool_name, limiter.max_limit)
+        self.in_flight = 0
+        self.waiters = deque()
+
+        self.slow_start = True
+        # moving average of the window p95, the latency of the host when it is not overloaded,
+        # it follows the host when its latency changes for reasons other than the load
+        self.baseline_p95 = None
+        self.latencies = list()
+        self.errors = 0
+        # completions of requests sent before the last cut, they do not reflect the new limit
+        self.stale_samples = 0
+
+    async def acquire(self):
+        while self.in_flight >= self.limit:
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # the wakeup may have been meant for this waiter, pass it on
+                self._wake_waiters()
+                raise
+            finally:
+                try:
+                    self.waiters.remove(waiter)
+                except ValueError:
+                    pass
+        self.in_flight += 1
+        return self
+
+    def release(self, latency, failed):
+        self.in_flight -= 1
+        if self.stale_samples > 0:
+            self.stale_samples -= 1
+        elif latency is not None:
+            self.latencies.append(latency)
+            if failed:
+                self.errors += 1
+            if len(self.latencies) >= self.limiter.window_size:
+                self._adjust()
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        free_slots = int(self.limit) - self.in_flight
+        for waiter in self.waiters:
+            if free_slots <= 0:
+                break
+            if not waiter.done():
+                waiter.set_result(None)
+                free_slots -= 1
+
+    def _adjust(self):
+        latencies = sorted(self.latencies)
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        error_rate = self.errors / len(latencies)
+        self.latencies = list()
+        self.errors = 0
+
+        if self.baseline_p95 is None:
+            self.baseline_p95 = p95
+        latency_threshold = max(self.baseline_p95 * self.limiter.latency_tolerance, self.limiter.min_latency)
+        # updated after the check, a single fast window does not pin the baseline
+        self.baseline_p95 += self.limiter.baseline_weight * (p95 - self.baseline_p95)
+        previous_limit = self.limit
+
+        if error_rate > self.limiter.max_error_rate or p95 > latency_threshold:
+            self.slow_start = False
+            self.limit = max(self.limiter.min_limit, int(self.limit * self.limiter.decrease_factor))
+            self.stale_samples = self.in_flight
+        elif self.slow_start:
+            self.limit = min(self.max_limit, self.limit * 2)
+        else:
+            self.limit = min(self.max_limit, self.limit + self.limiter.increase_step)
+
+        if self.limiter.metrics is not None and self.limit != previous_limit:
+            self.limiter.metrics.observe_limit(self.host, self.pool_name, self.limit, p95, error_rate)
+
+
+# Per host and connection pool concurrency limits of a crawler, every host starts at initial_limit.
+# max_limits: pool name => highest limit, max_limit for the other pools.
+class AdaptiveLimiter:
+
+    def __init__(self, initial_limit=10, min_limit=1, max_limit=60, max_limits=None, window_size=20,
+                 latency_tolerance=2.0, min_latency=0.25, max_error_rate=0.05, baseline_weight=0.2,
+                 increase_step=1, decrease_factor=0.5, metrics=None):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_limits = max_limits or dict()
+        self.window_size = window_size
+        # p95 over tolerance x the unloaded p95 is degraded, latencies below min_latency never are
+        self.latency_tolerance = latency_tolerance
+        self.min_latency = min_latency
+        # weight of a new window p95 in the moving baseline
+        self.baseline_weight = baseline_weight
+        self.max_error_rate = max_error_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.metrics = metrics
+
+        # (host, pool name) => HostLimit
+        self.hosts = dict()
+
+    async def acquire(self, host, pool_name):
+        host_limit = self.hosts.get((host, pool_name))
+        if host_limit is None:
+            host_limit = HostLimit(self, host, pool_name)
+            self.hosts[(host, pool_name)] = host_limit
+            if self.metrics is not None:
+                self.metrics.observe_limit(host, pool_name, host_limit.limit, None, None)
+        return await host_limit.acquire()
@@ -1,44 +1,244 @@
-from itertools import islice
+from http_cache import HttpCache
+from blob_store import BlobStore
+from crawl_metrics import CrawlMetrics
+from retry_policy import RetryPolicy
+from adaptive_limiter import AdaptiveLimiter
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor
+import logutil
+import logging
 import asyncio
 import aiohttp
 import aiofiles
+import hashlib
+import json
+import time
 import ssl
+import os
+
+
+log = logging.getLogger("async_crawler")
+logutil.init_log(log, logging.DEBUG)
 
 
 class AsyncCrawler:
-    def __init__(self, max_concurrency=200):
+    # runtime resources left out when the crawler is pickled to run its parse methods in a process pool
+    unpicklable_attributes = ("session", "asset_session", "bounded_semaphore", "ssl_ctx",
+                              "http_cache", "parse_executor", "blob_store", "metrics", "host_limiter",
+                              "shared_semaphore")
+
+    def __init__(self, max_concurrency=200, limit_per_host=30, asset_max_concurrency=100,
+                 asset_limit_per_host=30, keepalive_timeout=60, dns_cache_ttl=600,
+                 cache_dir=None, cache_max_size=512 * 1024 * 1024, parse_workers=None,
+                 blob_store_dir=None, metrics_file=None, prometheus_file=None, retry_policy=None,
+                 adaptive_concurrency=True, semaphore=None):
         self.max_concurrency = max_concurrency
         self.session = None
         self.bounded_semaphore = None
+        # concurrency budget shared with the other crawlers of a run, instead of max_concurrency
+        self.shared_semaphore = semaphore
+
+        # html/json pages and assets (images) use separate connection pools,
+        # so image downloads do not take the connections needed to crawl pages
+        self.limit_per_host = limit_per_host
+        self.asset_max_concurrency = asset_max_concurrency
+        self.asset_limit_per_host = asset_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.asset_session = None
+        self.download_chunk_size = 64 * 1024
+
+        # pool name => connection counters, filled by the session trace callbacks
+        self.connection_stats = dict()
+
+        # on-disk cache of pages revalidated with If-None-Match / If-Modified-Since
+        self.http_cache = None
+        if cache_dir is not None:
+            self.http_cache = HttpCache(cache_dir, cache_max_size)
+
+        # opt-in: number of processes parsing pages, so parsing does not block the event loop
+        self.parse_workers = parse_workers
+        self.parse_executor = None
+
+        # shared content addressed store the downloaded images are linked from
+        self.blob_store = None
+        if blob_store_dir is not None:
+            self.blob_store = BlobStore(blob_store_dir)
+
+        # backoff between the attempts of failed requests
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+
+        # json summary is always logged, the files are optional
+        self.metrics = CrawlMetrics(type(self).__name__)
+        self.metrics_file = metrics_file
+        self.prometheus_file = prometheus_file
+
+        # per host concurrency tuned from the latency and errors of its requests,
+        # below the fixed max_concurrency and connection pool limits
+        self.host_limiter = None
+        if adaptive_concurrency:
+            self.host_limiter = AdaptiveLimiter(initial_limit=min(10, limit_per_host),
+                                                max_limits={"pages": limit_per_host,
+                                                            "assets": asset_limit_per_host},
+                                                metrics=self.metrics)
 
     async def __aenter__(self):
         self.ssl_ctx = ssl.create_default_context()
         self.ssl_ctx.set_ciphers('HIGH:!DH:!aNULL')
-        self.session = aiohttp.ClientSession()
-        self.bounded_semaphore = asyncio.BoundedSemaphore(self.max_concurrency)
+        self.session = self._create_session("pages", self.max_concurrency, self.limit_per_host)
+        self.asset_session = self._create_session("assets", self.asset_max_concurrency,
+                                                  self.asset_limit_per_host)
+        if self.shared_semaphore is not None:
+            self.bounded_semaphore = self.shared_semaphore
+        else:
+            self.bounded_semaphore = asyncio.BoundedSemaphore(self.max_concurrency)
+        if self.http_cache is not None:
+            self.http_cache.open()
+        if self.blob_store is not None:
+            self.blob_store.open()
+        self.metrics.start()
+        if self.parse_workers:
+            self.parse_executor = ProcessPoolExecutor(max_workers=self.parse_workers)
         return self
 
     async def __aexit__(self, *err):
         await self.session.close()
+        await self.asset_session.close()
         self.session = None
+        self.asset_session = None
+        for pool_name, stats in self.connection_stats.items():
+            log.debug("Connection pool: %s %s" % (pool_name, stats))
+        if self.http_cache is not None:
+            self.http_cache.close()
+        if self.blob_store is not None:
+            self.blob_store.close()
+        if self.parse_executor is not None:
+            self.parse_executor.shutdown(wait=True)
+            self.parse_executor = None
 
-    async def _http_request(self, url):
-        async with self.bounded_semaphore:
-            max_retry = 5
-            while True:
-                try:
-                    async with self.session.get(url, timeout=30, ssl=self.ssl_ctx) as response:
-                    #async with self.session.request("GET", url, timeout=30, ssl=False) as response:
-                        response.raise_for_status()
-                        html = await response.read()
-                        return html
-                #except aiohttp.ClientConnectionError as e:
-                #    print('Error handled')
-                except aiohttp.ClientError:
-                    max_retry -= 1
-                    if max_retry == 0:
-                        return None
-                    print("Retry on url: ", url)
+        await self.metrics.stop()
+        log.info("Crawl metrics: %s" % json.dumps(self.metrics.summary()))
+        if self.metrics_file is not None:
+            self.metrics.write_json(self.metrics_file)
+        if self.prometheus_file is not None:
+            self.metrics.write_prometheus(self.prometheus_file)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attribute in self.unpicklable_attributes:
+            state.pop(attribute, None)
+        return state
+
+    async def run_parser(self, parse_function, *args):
+        # parse functions take the page bytes and return plain data, so they can run in another process
+        if self.parse_executor is None:
+            return parse_function(*args)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.parse_executor, parse_function, *args)
+
+    def _create_session(self, pool_name, limit, limit_per_host):
+        stats = {
+            "requests": 0,
+            "created": 0,
+            "reused": 0,
+            "queued": 0,
+            "dns_cache_hit": 0,
+            "dns_cache_miss": 0
+        }
+        self.connection_stats[pool_name] = stats
+
+        def count(stat_name):
+            async def on_event(session, trace_config_ctx, params):
+                stats[stat_name] += 1
+            return on_event
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(count("requests"))
+        trace_config.on_connection_create_end.append(count("created"))
+        trace_config.on_connection_reuseconn.append(count("reused"))
+        trace_config.on_connection_queued_start.append(count("queued"))
+        trace_config.on_dns_cache_hit.append(count("dns_cache_hit"))
+        trace_config.on_dns_cache_miss.append(count("dns_cache_miss"))
+
+        connector = aiohttp.TCPConnector(limit=limit,
+                                         limit_per_host=limit_per_host,
+                                         keepalive_timeout=self.keepalive_timeout,
+                                         use_dns_cache=True,
+                                         ttl_dns_cache=self.dns_cache_ttl)
+        return aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+
+    async def _http_request(self, url, session=None):
+        if session is None:
+            session = self.session
+        # only page requests are cached, assets are kept on disk by the crawlers
+        http_cache = self.http_cache if session is self.session else None
+        pool_name = "pages" if session is self.session else "assets"
+
+        attempt = 0
+        while True:
+            retry_after = None
+            latency = None
+            failed = False
+            host_limit = await self._acquire_host_limit(url, pool_name)
+            try:
+                # the concurrency slot is only held while the request is sent, not during the backoff
+                async with self.bounded_semaphore:
+                    headers = http_cache.request_headers(url) if http_cache is not None else None
+                    start_time = time.perf_counter()
+                    self.metrics.request_started()
+                    try:
+                        async with session.get(url, headers=headers, timeout=30, ssl=self.ssl_ctx) as response:
+                        #async with self.session.request("GET", url, timeout=30, ssl=False) as response:
+                            # the host limit is tuned on the time to the response headers, the body
+                            # transfer depends on its size
+                            latency = time.perf_counter() - start_time
+                            self.metrics.observe_status(pool_name, response.status)
+                            if response.status == 304 and http_cache is not None:
+                                html = http_cache.get(url)
+                                self.metrics.observe_transfer(pool_name, time.perf_counter() - start_time, 0)
+                                if html is not None:
+                                    return html
+                                # cached body vanished, request it again without validators
+                                continue
+                            response.raise_for_status()
+                            html = await response.read()
+                            self.metrics.observe_transfer(pool_name, time.perf_counter() - start_time, len(html))
+                            if http_cache is not None:
+                                http_cache.put(url, response.headers, html)
+                            return html
+                    except aiohttp.ClientResponseError as e:
+                        self.metrics.count_error(pool_name, e)
+                        if not self.retry_policy.is_retryable_status(e.status):
+                            log.error("Request failed: %s (%s)" % (url, e.status))
+                            return None
+                        retry_after = self.retry_policy.get_retry_after(e.status, e.headers)
+                        failed = True
+                        error = e
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        self.metrics.count_error(pool_name, e)
+                        failed = True
+                        error = e
+                    finally:
+                        self.metrics.request_finished()
+                        if latency is None:
+                            latency = time.perf_counter() - start_time
+            finally:
+                if host_limit is not None:
+                    host_limit.release(latency, failed)
+
+            attempt += 1
+            if attempt >= self.retry_policy.max_attempts:
+                log.error("Request failed after %d attempts: %s (%s: %s)" % (attempt, url, type(error).__name__, error))
+                return None
+            self.metrics.count_retry(pool_name)
+            delay = self.retry_policy.get_delay(attempt, retry_after)
+            log.warning("Retry on url: %s in %.2f seconds (%s: %s)" % (url, delay, type(error).__name__, error))
+            await asyncio.sleep(delay)
+
+    async def _acquire_host_limit(self, url, pool_name):
+        if self.host_limiter is None:
+            return None
+        return await self.host_limiter.acquire(urlsplit(url).netloc, pool_name)
 
     async def extract_async(self, url):
         data = await self._http_request(url)
@@ -48,37 +248,145 @@ class AsyncCrawler:
     #async def extract_multi_async(self, to_fetch):
     #    return await asyncio.gather(*[self.extract_async(url) for url in to_fetch], return_exceptions=True)
 
-    #async def download_file(self, url, local_file_path):
-    #    async with self.bounded_semaphore:
-    #        #async with self.session.get(url, timeout=30) as response:
-    #        async with self.session.get(url, timeout=30, ssl=self.ssl_ctx) as response:
-    #            if response.status == 200:
-    #                f = await aiofiles.open(local_file_path, mode='wb')
-    #                await f.write(await response.read())
-    #                await f.close()
-
     async def download_file(self, url, local_file_path):
-        data = await self._http_request(url)
-        f = await aiofiles.open(local_file_path, mode='wb')
-        await f.write(data)
-        await f.close()
+        # Stream the body in fixed size chunks into a partial file which is renamed once complete,
+        # so memory per download stays bounded and no truncated image is left under the final name
+        part_file_path = local_file_path + ".part"
+        if self.blob_store is not None and self.blob_store.link_existing(url, local_file_path):
+            return True
+
+        attempt = 0
+        while True:
+            retry_after = None
+            latency = None
+            failed = False
+            host_limit = await self._acquire_host_limit(url, "assets")
+            try:
+                async with self.bounded_semaphore:
+                    start_time = time.perf_counter()
+                    self.metrics.request_started()
+                    try:
+                        async with self.asset_session.get(url, timeout=30, ssl=self.ssl_ctx) as response:
+                            latency = time.perf_counter() - start_time
+                            self.metrics.observe_status("assets", response.status)
+                            response.raise_for_status()
+                            size = 0
+                            digest = hashlib.sha256()
+                            async with aiofiles.open(part_file_path, mode='wb') as f:
+                                async for chunk in response.content.iter_chunked(self.download_chunk_size):
+                                    await f.write(chunk)
+                                    digest.update(chunk)
+                                    size += len(chunk)
+
+                            # content length is the size of the encoded body, only check it for identity encoding
+                            if response.content_length is not None and \
+                                    response.headers.get("Content-Encoding", "identity") == "identity" and \
+                                    size != response.content_length:
+                                raise aiohttp.ClientPayloadError(
+                                    "Got %d bytes of %d from: %s" % (size, response.content_length, url))
+                            self.metrics.observe_transfer("assets", time.perf_counter() - start_time, size)
+
+                        if self.blob_store is not None:
+                            self.blob_store.store_file(url, digest.hexdigest(), part_file_path, local_file_path)
+                        else:
+                            os.replace(part_file_path, local_file_path)
+                        return True
+                    except aiohttp.ClientResponseError as e:
+                        AsyncCrawler._remove_file(part_file_path)
+                        self.metrics.count_error("assets", e)
+                        if not self.retry_policy.is_retryable_status(e.status):
+                            log.error("Download failed: %s (%s)" % (url, e.status))
+                            return False
+                        retry_after = self.retry_policy.get_retry_after(e.status, e.headers)
+                        failed = True
+                        error = e
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        AsyncCrawler._remove_file(part_file_path)
+                        self.metrics.count_error("assets", e)
+                        failed = True
+                        error = e
+                    except BaseException:
+                        AsyncCrawler._remove_file(part_file_path)
+                        raise
+                    finally:
+                        self.metrics.request_finished()
+                        if latency is None:
+                            latency = time.perf_counter() - start_time
+            finally:
+                if host_limit is not None:
+                    host_limit.release(latency, failed)
+
+            attempt += 1
+            if attempt >= self.retry_policy.max_attempts:
+                log.error("Download failed after %d attempts: %s (%s: %s)" % (attempt, url, type(error).__name__, error))
+                return False
+            self.metrics.count_retry("assets")
+            delay = self.retry_policy.get_delay(attempt, retry_after)
+            log.warning("Retry download: %s in %.2f seconds (%s: %s)" % (url, delay, type(error).__name__, error))
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _remove_file(file_path):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def start_workers(queue, handler, num_workers):
+        # Each worker consumes items from the queue until it gets the None sentinel
+        async def worker():
+            while True:
+                item = await queue.get()
+                try:
+                    if item is None:
+                        return
+                    await handler(item)
+                except Exception:
+                    log.exception("Worker %s failed on item: %s" % (handler.__name__, item))
+                finally:
+                    queue.task_done()
+
+        return [asyncio.ensure_future(worker()) for _ in range(num_workers)]
+
+    @staticmethod
+    async def stop_workers(queue, workers):
+        # sentinels are queued after the pending items, so the workers drain the queue first
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
 
     @staticmethod
     def limited_as_completed(coroutines, limit=1):
-        futures = [asyncio.ensure_future(c) for c in islice(coroutines, 0, limit)]
+        # Yields awaitables returning the results in completion order, with at most `limit`
+        # coroutines running at once. Exceptions are raised per task by the awaitable that
+        # returns it, so the caller can handle them and keep iterating. Closing the generator
+        # (or leaving the loop) cancels the coroutines that are still running.
+        coroutines = iter(coroutines)
+        pending = set()
+        # futures are pushed here by their done callback, no polling of the pending set
+        finished = asyncio.Queue()
+
+        def schedule_next():
+            try:
+                f = asyncio.ensure_future(next(coroutines))
+            except StopIteration:
+                return
+            pending.add(f)
+            f.add_done_callback(finished.put_nowait)
+
+        for _ in range(limit):
+            schedule_next()
 
         async def first_to_finish():
-            while True:
-                await asyncio.sleep(0)
-                for f in futures:
-                    if f.done():
-                        futures.remove(f)
-                        try:
-                            new_future = next(coroutines)
-                            futures.append(asyncio.ensure_future(new_future))
-                        except StopIteration as e:
-                            pass
-                        return f.result()
-
-        while len(futures) > 0:
-            yield first_to_finish()
+            f = await finished.get()
+            pending.remove(f)
+            schedule_next()
+            return f.result()
+
+        try:
+            while pending:
+                yield first_to_finish()
+        finally:
+            for f in pending:
+                f.cancel()
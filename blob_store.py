@@ -0,0 +1,146 @@
+from tempfile import NamedTemporaryFile
+import logutil
+import logging
+import json
+import sys
+import os
+
+
+log = logging.getLogger("blob_store")
+logutil.init_log(log, logging.DEBUG)
+
+
+# Content addressed image store shared by all auctions and categories. Blobs are named by the sha256
+# of their bytes in sharded directories and hard linked (symlinked across file systems) into the
+# auction directories, the index maps the source image url to its blob.
+class BlobStore:
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.blobs_dir = os.path.join(root_dir, "blobs")
+        self.index_file_path = os.path.join(root_dir, "index.json")
+        # present once a blob was symlinked, such a blob has a single hard link while it is in use
+        self.symlinked_file_path = os.path.join(root_dir, "symlinked")
+
+        # source url => digest
+        self.index = dict()
+
+        self.stored = 0
+        self.deduplicated = 0
+        self.reused = 0
+
+    def open(self):
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        self.index = self._read_index()
+
+    def _read_index(self):
+        if not os.path.isfile(self.index_file_path):
+            return dict()
+        try:
+            with open(self.index_file_path, "r", encoding="utf-8") as index_file:
+                return json.load(index_file)
+        except ValueError:
+            log.warning("Corrupted blob index: %s, starting empty" % self.index_file_path)
+            return dict()
+
+    def close(self):
+        self._save_index()
+        log.debug("Blobs stored: %d, deduplicated: %d, reused without download: %d" %
+                  (self.stored, self.deduplicated, self.reused))
+
+    def _save_index(self, merge=True):
+        if merge:
+            # crawlers running at the same time share the store, keep the urls the others added
+            index = self._read_index()
+            index.update(self.index)
+            self.index = index
+        with NamedTemporaryFile(mode="w", dir=self.root_dir, delete=False, encoding="utf-8") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(index_file.name, self.index_file_path)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs_dir, digest[:2], digest[2:4], digest)
+
+    def lookup(self, source_url):
+        digest = self.index.get(source_url)
+        if digest is not None and os.path.isfile(self.blob_path(digest)):
+            return digest
+        return None
+
+    def link(self, digest, file_path):
+        blob_path = self.blob_path(digest)
+        try:
+            os.link(blob_path, file_path)
+        except FileExistsError:
+            pass
+        except OSError:
+            # hard links do not work across file systems
+            os.symlink(blob_path, file_path)
+            if not os.path.isfile(self.symlinked_file_path):
+                open(self.symlinked_file_path, "w").close()
+
+    def link_existing(self, source_url, file_path):
+        # links the blob of an already downloaded image, False when it has to be downloaded
+        digest = self.lookup(source_url)
+        if digest is None:
+            return False
+        self.link(digest, file_path)
+        self.reused += 1
+        return True
+
+    def store_file(self, source_url, digest, downloaded_file_path, file_path):
+        blob_path = self.blob_path(digest)
+        if os.path.isfile(blob_path):
+            os.remove(downloaded_file_path)
+            self.deduplicated += 1
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(downloaded_file_path, blob_path)
+            self.stored += 1
+
+        self.index[source_url] = digest
+        self.link(digest, file_path)
+
+    def gc(self, linked_dirs=()):
+        # a blob is orphaned when no auction directory links to it: no other hard link,
+        # and no symlink from the given directories
+        if not linked_dirs and os.path.isfile(self.symlinked_file_path):
+            log.error("Blobs of %s are symlinked, gc needs the output directories linking to them" % self.root_dir)
+            return 0
+
+        symlinked = set()
+        for linked_dir in linked_dirs:
+            for dir_path, _, file_names in os.walk(linked_dir):
+                for file_name in file_names:
+                    file_path = os.path.join(dir_path, file_name)
+                    if os.path.islink(file_path):
+                        symlinked.add(os.path.realpath(file_path))
+
+        removed = 0
+        removed_size = 0
+        for dir_path, _, file_names in os.walk(self.blobs_dir):
+            for file_name in file_names:
+                blob_path = os.path.join(dir_path, file_name)
+                stat = os.stat(blob_path)
+                if stat.st_nlink <= 1 and os.path.realpath(blob_path) not in symlinked:
+                    os.remove(blob_path)
+                    removed += 1
+                    removed_size += stat.st_size
+
+        self.index = {source_url: digest for source_url, digest in self.index.items()
+                      if os.path.isfile(self.blob_path(digest))}
+        self._save_index(merge=False)
+
+        log.debug("Removed %d orphaned blobs (%d bytes)" % (removed, removed_size))
+        return removed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] != "gc":
+        # the output dirs are required once the store had to symlink (auction dirs on another file system)
+        print("Usage: %s gc <blob store dir> [<output dir with symlinked images> ...]" % sys.argv[0])
+        sys.exit(1)
+
+    blob_store = BlobStore(sys.argv[2])
+    blob_store.open()
+    blob_store.gc(sys.argv[3:])
@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.chrome.options import Options
+import logutil
+import logging
+import threading
+import asyncio
+
+
+log = logging.getLogger("browser_pool")
+logutil.init_log(log, logging.DEBUG)
+
+
+class BrowserPool:
+
+    def __init__(self, num_browsers=4, recycle_after=100, executable_path="/bin/chromedriver"):
+        self.num_browsers = num_browsers
+        # restart a browser after it rendered that many pages to bound its memory growth
+        self.recycle_after = recycle_after
+        self.executable_path = executable_path
+
+        self.executor = None
+        # every executor thread owns one driver
+        self.local = threading.local()
+        self.drivers = set()
+        self.drivers_lock = threading.Lock()
+
+        self.pages_rendered = 0
+        self.drivers_started = 0
+
+    def _create_driver(self):
+        chrome_options = Options()
+        chrome_options.add_argument("--headless")
+        chrome_options.add_argument("--no-sandbox")
+        chrome_options.add_argument("--disable-dev-shm-usage")
+
+        driver = webdriver.Chrome(executable_path=self.executable_path, options=chrome_options)
+        with self.drivers_lock:
+            self.drivers.add(driver)
+            self.drivers_started += 1
+        return driver
+
+    def _quit_driver(self, driver):
+        with self.drivers_lock:
+            self.drivers.discard(driver)
+        try:
+            driver.quit()
+        except WebDriverException:
+            log.warning("Failed to quit browser")
+
+    def _get_page_source(self, url):
+        driver = getattr(self.local, "driver", None)
+        if driver is not None and self.local.pages >= self.recycle_after:
+            self._quit_driver(driver)
+            driver = None
+
+        if driver is None:
+            driver = self._create_driver()
+            self.local.driver = driver
+            self.local.pages = 0
+
+        self.local.pages += 1
+        try:
+            driver.get(url)
+            page_source = driver.page_source
+        except WebDriverException:
+            # the browser may have crashed, the next page starts a fresh one
+            self._quit_driver(driver)
+            self.local.driver = None
+            raise
+
+        with self.drivers_lock:
+            self.pages_rendered += 1
+        return page_source
+
+    async def get_page_source(self, url):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.num_browsers)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self._get_page_source, url)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+        for driver in list(self.drivers):
+            self._quit_driver(driver)
+
+        log.debug("Browsers started: %d, pages rendered: %d" % (self.drivers_started, self.pages_rendered))
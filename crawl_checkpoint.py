@@ -0,0 +1,125 @@
+import logutil
+import logging
+import json
+import time
+import os
+
+
+log = logging.getLogger("crawl_checkpoint")
+logutil.init_log(log, logging.DEBUG)
+
+
+# Progress of the crawl of one category appended to a jsonl file, so a killed run can be resumed:
+# the listing pages whose auctions are all written, the written auction ids and the images waiting
+# for download. Auction ids are recorded in batches, only after the storage synced their rows.
+# The file is removed when the crawl completes.
+class CrawlCheckpoint:
+
+    def __init__(self, file_path, storage, resume=False, sync_every=50, sync_interval=10.0):
+        self.file_path = file_path
+        self.storage = storage
+        self.resume = resume
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        # progress of the interrupted run
+        self.pages_done = set()
+        self.auctions_done = set()
+        # image file path => url
+        self.pending_images = dict()
+
+        # page url => auction ids of the page not written yet, auction id => pages listing it
+        self.page_auctions = dict()
+        self.auction_pages = dict()
+        # written since the last sync
+        self.unsynced_auctions = list()
+        self.last_sync_time = time.time()
+
+        self.checkpoint_file = None
+
+    def open(self):
+        if self.resume and os.path.isfile(self.file_path):
+            self._load()
+            log.info("Resuming from checkpoint: %s, pages done: %d, auctions done: %d, pending images: %d" %
+                     (self.file_path, len(self.pages_done), len(self.auctions_done), len(self.pending_images)))
+            self.checkpoint_file = open(self.file_path, "a", encoding="utf-8")
+        else:
+            self.checkpoint_file = open(self.file_path, "w", encoding="utf-8")
+
+    def _load(self):
+        with open(self.file_path, "r", encoding="utf-8") as checkpoint_file:
+            for line in checkpoint_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line of a killed run can be cut
+                    continue
+                if "page" in record:
+                    self.pages_done.add(record.get("page"))
+                elif "auction" in record:
+                    self.auctions_done.add(record.get("auction"))
+                elif "image" in record:
+                    self.pending_images[record.get("path")] = record.get("image")
+                elif "image_done" in record:
+                    self.pending_images.pop(record.get("image_done"), None)
+
+    def close(self):
+        # called once the category is complete, the next run starts from scratch
+        if self.checkpoint_file is not None:
+            self.checkpoint_file.close()
+            self.checkpoint_file = None
+            os.remove(self.file_path)
+
+    def interrupt(self):
+        # called when the crawl of the category failed, the file is kept for a resumed run
+        if self.checkpoint_file is not None:
+            self.sync()
+            self.checkpoint_file.close()
+            self.checkpoint_file = None
+
+    def _write(self, record):
+        self.checkpoint_file.write(json.dumps(record) + "\n")
+
+    def is_page_done(self, page_url):
+        return page_url in self.pages_done
+
+    def is_auction_done(self, auction_id):
+        return str(auction_id) in self.auctions_done
+
+    def page_listed(self, page_url, auction_ids):
+        # the page is done when every auction listed on it is done
+        auction_ids = set(str(auction_id) for auction_id in auction_ids) - self.auctions_done
+        if not auction_ids:
+            self._write({"page": page_url})
+            return
+        self.page_auctions[page_url] = auction_ids
+        for auction_id in auction_ids:
+            self.auction_pages.setdefault(auction_id, set()).add(page_url)
+
+    def auction_done(self, auction_id):
+        self.unsynced_auctions.append(str(auction_id))
+        if len(self.unsynced_auctions) >= self.sync_every or \
+                time.time() - self.last_sync_time >= self.sync_interval:
+            self.sync()
+
+    def image_queued(self, img_url, img_file_path):
+        self._write({"image": img_url, "path": img_file_path})
+
+    def image_done(self, img_file_path):
+        self._write({"image_done": img_file_path})
+
+    def sync(self):
+        # rows first, so no auction is marked done before its row is on disk
+        self.storage.sync()
+        for auction_id in self.unsynced_auctions:
+            self.auctions_done.add(auction_id)
+            self._write({"auction": auction_id})
+            for page_url in self.auction_pages.pop(auction_id, ()):
+                page_auctions = self.page_auctions.get(page_url)
+                page_auctions.discard(auction_id)
+                if not page_auctions:
+                    del self.page_auctions[page_url]
+                    self._write({"page": page_url})
+        self.unsynced_auctions = list()
+        self.checkpoint_file.flush()
+        self.last_sync_time = time.time()
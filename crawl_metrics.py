@@ -0,0 +1,238 @@
+from tempfile import NamedTemporaryFile
+from collections import Counter, deque
+import contextlib
+import logutil
+import logging
+import asyncio
+import json
+import time
+import os
+
+
+log = logging.getLogger("crawl_metrics")
+logutil.init_log(log, logging.DEBUG)
+
+
+# Request latencies (per connection pool), transferred bytes, status codes, retries, errors,
+# the number of requests in flight over time, the time spent in each crawl stage and the
+# adaptive concurrency limit of every host.
+# Summarized as json at the end of the run, optionally written in the prometheus text format.
+class CrawlMetrics:
+    # upper bounds of the latency histogram buckets, in seconds
+    latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf"))
+
+    def __init__(self, name, sample_interval=1.0, max_samples=600):
+        self.name = name
+        self.sample_interval = sample_interval
+
+        # pool name => request counters and latency histogram
+        self.pools = dict()
+        # stage name => {"count", "seconds", "max_seconds"}
+        self.stages = dict()
+        # pool name => host => {"limit", "history": [(seconds since start, limit, p95 latency, error rate)]}
+        self.limits = dict()
+
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        # (seconds since start, requests in flight) of the last max_samples samples,
+        # a long run does not grow the summary, peak_in_flight covers the whole run
+        self.in_flight_samples = deque(maxlen=max_samples)
+
+        self.start_time = None
+        self.end_time = None
+        self.sampler = None
+
+    def start(self):
+        self.start_time = time.time()
+        self.sampler = asyncio.ensure_future(self._sample_in_flight())
+
+    async def stop(self):
+        self.end_time = time.time()
+        if self.sampler is not None:
+            self.sampler.cancel()
+            try:
+                await self.sampler
+            except asyncio.CancelledError:
+                pass
+            self.sampler = None
+
+    async def _sample_in_flight(self):
+        while True:
+            self.in_flight_samples.append((round(time.time() - self.start_time, 3), self.in_flight))
+            await asyncio.sleep(self.sample_interval)
+
+    def _pool(self, pool_name):
+        pool = self.pools.get(pool_name)
+        if pool is None:
+            pool = {
+                "requests": 0,
+                "bytes": 0,
+                "retries": 0,
+                "latency_sum": 0.0,
+                "latency_buckets": [0] * len(self.latency_buckets),
+                "status": Counter(),
+                "errors": Counter()
+            }
+            self.pools[pool_name] = pool
+        return pool
+
+    def request_started(self):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def request_finished(self):
+        self.in_flight -= 1
+
+    def observe_status(self, pool_name, status):
+        self._pool(pool_name)["status"][str(status)] += 1
+
+    def observe_transfer(self, pool_name, latency, size):
+        pool = self._pool(pool_name)
+        pool["requests"] += 1
+        pool["bytes"] += size
+        pool["latency_sum"] += latency
+        for i, upper_bound in enumerate(self.latency_buckets):
+            if latency <= upper_bound:
+                pool["latency_buckets"][i] += 1
+                break
+
+    def count_retry(self, pool_name):
+        self._pool(pool_name)["retries"] += 1
+
+    def count_error(self, pool_name, error):
+        self._pool(pool_name)["errors"][type(error).__name__] += 1
+
+    def observe_stage(self, stage_name, seconds):
+        stage = self.stages.get(stage_name)
+        if stage is None:
+            stage = {"count": 0, "seconds": 0.0, "max_seconds": 0.0}
+            self.stages[stage_name] = stage
+        stage["count"] += 1
+        stage["seconds"] += seconds
+        stage["max_seconds"] = max(stage["max_seconds"], seconds)
+
+    def observe_limit(self, host, pool_name, limit, p95, error_rate):
+        pool_limits = self.limits.setdefault(pool_name, dict())
+        host_limits = pool_limits.get(host)
+        if host_limits is None:
+            host_limits = {"limit": limit, "history": list()}
+            pool_limits[host] = host_limits
+        host_limits["limit"] = limit
+        elapsed = round(time.time() - self.start_time, 3) if self.start_time is not None else 0.0
+        host_limits["history"].append((elapsed, limit, p95, error_rate))
+
+    @contextlib.contextmanager
+    def timer(self, stage_name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage_name, time.perf_counter() - start_time)
+
+    def latency_quantile(self, pool_name, quantile):
+        # upper bound of the bucket holding the quantile
+        pool = self.pools.get(pool_name)
+        if pool is None or not pool["requests"]:
+            return None
+        rank = quantile * pool["requests"]
+        count = 0
+        for upper_bound, bucket_count in zip(self.latency_buckets, pool["latency_buckets"]):
+            count += bucket_count
+            if count >= rank:
+                return upper_bound
+        return self.latency_buckets[-1]
+
+    def summary(self):
+        end_time = self.end_time if self.end_time is not None else time.time()
+        pools = dict()
+        for pool_name, pool in self.pools.items():
+            pools[pool_name] = {
+                "requests": pool["requests"],
+                "bytes": pool["bytes"],
+                "retries": pool["retries"],
+                "latency_mean": pool["latency_sum"] / pool["requests"] if pool["requests"] else None,
+                "latency_p50": self.latency_quantile(pool_name, 0.5),
+                "latency_p95": self.latency_quantile(pool_name, 0.95),
+                "latency_histogram": {str(upper_bound): count for upper_bound, count
+                                      in zip(self.latency_buckets, pool["latency_buckets"])},
+                "status": dict(pool["status"]),
+                "errors": dict(pool["errors"])
+            }
+
+        return {
+            "crawler": self.name,
+            "duration": round(end_time - self.start_time, 3) if self.start_time is not None else None,
+            "pools": pools,
+            "stages": self.stages,
+            "limits": self.limits,
+            "peak_in_flight": self.peak_in_flight,
+            "in_flight_samples": list(self.in_flight_samples)
+        }
+
+    def write_json(self, file_path):
+        CrawlMetrics._write_atomic(file_path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, file_path):
+        crawler_label = 'crawler="%s"' % self.name
+        lines = list()
+
+        lines.append("# TYPE crawler_request_duration_seconds histogram")
+        for pool_name, pool in self.pools.items():
+            labels = '%s,pool="%s"' % (crawler_label, pool_name)
+            count = 0
+            for upper_bound, bucket_count in zip(self.latency_buckets, pool["latency_buckets"]):
+                count += bucket_count
+                le = "+Inf" if upper_bound == float("inf") else str(upper_bound)
+                lines.append('crawler_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, le, count))
+            lines.append("crawler_request_duration_seconds_sum{%s} %f" % (labels, pool["latency_sum"]))
+            lines.append("crawler_request_duration_seconds_count{%s} %d" % (labels, pool["requests"]))
+
+        lines.append("# TYPE crawler_transferred_bytes_total counter")
+        for pool_name, pool in self.pools.items():
+            lines.append('crawler_transferred_bytes_total{%s,pool="%s"} %d' % (crawler_label, pool_name, pool["bytes"]))
+
+        lines.append("# TYPE crawler_retries_total counter")
+        for pool_name, pool in self.pools.items():
+            lines.append('crawler_retries_total{%s,pool="%s"} %d' % (crawler_label, pool_name, pool["retries"]))
+
+        lines.append("# TYPE crawler_responses_total counter")
+        for pool_name, pool in self.pools.items():
+            for status, count in sorted(pool["status"].items()):
+                lines.append('crawler_responses_total{%s,pool="%s",status="%s"} %d' %
+                             (crawler_label, pool_name, status, count))
+
+        lines.append("# TYPE crawler_errors_total counter")
+        for pool_name, pool in self.pools.items():
+            for error, count in sorted(pool["errors"].items()):
+                lines.append('crawler_errors_total{%s,pool="%s",error="%s"} %d' %
+                             (crawler_label, pool_name, error, count))
+
+        lines.append("# TYPE crawler_stage_duration_seconds summary")
+        for stage_name, stage in self.stages.items():
+            labels = '%s,stage="%s"' % (crawler_label, stage_name)
+            lines.append("crawler_stage_duration_seconds_sum{%s} %f" % (labels, stage["seconds"]))
+            lines.append("crawler_stage_duration_seconds_count{%s} %d" % (labels, stage["count"]))
+
+        lines.append("# TYPE crawler_host_concurrency_limit gauge")
+        for pool_name, pool_limits in self.limits.items():
+            for host, host_limits in pool_limits.items():
+                lines.append('crawler_host_concurrency_limit{%s,pool="%s",host="%s"} %d' %
+                             (crawler_label, pool_name, host, host_limits["limit"]))
+
+        lines.append("# TYPE crawler_peak_in_flight_requests gauge")
+        lines.append("crawler_peak_in_flight_requests{%s} %d" % (crawler_label, self.peak_in_flight))
+
+        summary = self.summary()
+        if summary["duration"] is not None:
+            lines.append("# TYPE crawler_run_duration_seconds gauge")
+            lines.append("crawler_run_duration_seconds{%s} %f" % (crawler_label, summary["duration"]))
+
+        CrawlMetrics._write_atomic(file_path, "\n".join(lines) + "\n")
+
+    @staticmethod
+    def _write_atomic(file_path, content):
+        # scrapers (node exporter textfile collector) never see a partially written file
+        dir_path = os.path.dirname(os.path.abspath(file_path))
+        with NamedTemporaryFile(mode="w", dir=dir_path, delete=False, encoding="utf-8") as f:
+            f.write(content)
+        os.replace(f.name, file_path)
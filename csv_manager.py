@@ -1,9 +1,9 @@
-from tempfile import NamedTemporaryFile
 from util import Util
 import logutil
 import logging
 import shutil
 import csv
+import os
 
 
 log = logging.getLogger("csv_manager")
@@ -20,35 +20,97 @@ class CsvManager:
 
         self.identity_field = identity_field
         self.updated_rows = set()
+        # identity value => row dict of the existing csv file, loaded once in open_file
+        self.rows_index = dict()
 
         self.csv_file = None
         self.temp_file = None
-        self.reader = None
+        # rows of an existing file are rewritten here, at a fixed path so an interrupted run can be resumed
+        self.temp_file_name = file_name + ".part"
         self.writer = None
         # if the csv file does not exist append directly to it
         self.no_check = True
 
     def _fix_row_types(self, row_dict):
         for field_name, field_value in row_dict.items():
-            if field_value:
+            # numbers are read back as floats, so 0 (e.g. the new flag) has to be converted too
+            if field_value is not None and field_value != "":
                 row_dict[field_name] = self.fields_to_type.get(field_name)(field_value)
 
     def _fix_row_key_type(self, row_dict, key):
         if key not in self.fields_names:
-            log.warning("Key: %s is not in csv filed names")
+            log.warning("Key: %s is not in csv filed names" % key)
 
         if row_dict.get(key) is not None:
             row_dict[key] = self.fields_to_type.get(key)(row_dict.get(key))
 
-    def open_file(self):
+    def _read_rows(self, file_name):
+        with open(file_name, "r", encoding="utf-8") as csv_file:
+            reader = csv.DictReader(csv_file, fieldnames=self.fields_names,
+                                    delimiter=",", quoting=csv.QUOTE_NONNUMERIC)
+            # skip the header
+            next(reader, None)
+            for row in reader:
+                self._fix_row_types(row)
+                yield row
+
+    def _load_index(self):
+        self.rows_index = dict()
+        for row in self._read_rows(self.file_name):
+            self.rows_index[row.get(self.identity_field)] = row
+
+        log.debug("Loaded %d rows from csv file: %s" % (len(self.rows_index), self.file_name))
+
+    @staticmethod
+    def _truncate_partial_row(file_name):
+        # a killed run can leave half a row at the end of the file, cut it at the last row terminator
+        with open(file_name, "rb+") as f:
+            end = f.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                chunk_start = max(0, position - 64 * 1024)
+                f.seek(chunk_start)
+                chunk = f.read(position - chunk_start)
+                index = chunk.rfind(b"\r\n")
+                if index != -1:
+                    row_end = chunk_start + index + 2
+                    if row_end != end:
+                        f.truncate(row_end)
+                        log.warning("Removed a partial row from: %s" % file_name)
+                    return
+                # overlap by one byte, the terminator can span two chunks
+                position = chunk_start + 1 if chunk_start > 0 else 0
+
+    def open_file(self, resume=False, done_ids=None):
+        # done_ids: identities (as str) the resumed crawl will not write again, the other rows
+        # of the interrupted run are dropped since they are crawled again
+        if resume and Util.check_file_exist(self.file_name):
+            CsvManager._truncate_partial_row(self.file_name)
+
         if Util.check_file_exist(self.file_name):
-            self.csv_file = open(self.file_name, "r", encoding="utf-8")
-            self.temp_file = NamedTemporaryFile(mode="w+", delete=False, encoding="utf-8")
-            self.reader = csv.DictReader(self.csv_file, fieldnames=self.fields_names,
-                                         delimiter=",", quoting=csv.QUOTE_NONNUMERIC)
+            self._load_index()
+
+            # rows written by the interrupted run are kept as updated rows
+            recovered_rows = list()
+            if Util.check_file_exist(self.temp_file_name):
+                if resume:
+                    CsvManager._truncate_partial_row(self.temp_file_name)
+                    recovered_rows = [row for row in self._read_rows(self.temp_file_name)
+                                      if done_ids is None or str(row.get(self.identity_field)) in done_ids]
+                    log.debug("Recovered %d rows from: %s" % (len(recovered_rows), self.temp_file_name))
+                else:
+                    log.warning("Discarding the rows of an interrupted run: %s" % self.temp_file_name)
+
+            # the original file is only read once, everything else is answered from the index
+            self.csv_file = None
+            self.temp_file = open(self.temp_file_name, "w", encoding="utf-8")
             self.writer = csv.DictWriter(self.temp_file, fieldnames=self.fields_names,
                                          delimiter=",", quoting=csv.QUOTE_NONNUMERIC)
             self.writer.writeheader()
+            for row in recovered_rows:
+                self.rows_index[row.get(self.identity_field)] = row
+                self.updated_rows.add(row.get(self.identity_field))
+                self.writer.writerow(row)
             self.no_check = False
         else:
             self.csv_file = open(self.file_name, "w", encoding="utf-8")
@@ -58,25 +120,31 @@ class CsvManager:
             self.no_check = True
 
     def close_file(self):
-        if self.csv_file is not None:
-            if not self.no_check:
-                # start from beginning and skip the header
-                self.csv_file.seek(0)
-                next(self.reader)
-                for row in self.reader:
-                    self._fix_row_types(row)
-                    if row.get(self.identity_field) in self.updated_rows:
-                        # log.debug("row: %s already was updated" % row)
-                        pass
-                    else:
-                        # log.debug("need to add row %s" % row)
-                        self.writer.writerow(row)
-
-                self.temp_file.flush()
+        if self.no_check:
+            if self.csv_file is not None:
                 self.csv_file.close()
-
-                if self.temp_file is not None:
-                    shutil.move(self.temp_file.name, self.file_name)
+                self.csv_file = None
+        elif self.temp_file is not None:
+            for identity, row in self.rows_index.items():
+                if identity not in self.updated_rows:
+                    self.writer.writerow(row)
+
+            self.temp_file.close()
+            shutil.move(self.temp_file_name, self.file_name)
+            self.temp_file = None
+
+    def sync(self):
+        # rows written so far are on disk when this returns
+        f = self.csv_file if self.no_check else self.temp_file
+        if f is not None:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def get_row(self, row_dict):
+        if self.no_check:
+            return None
+        self._fix_row_key_type(row_dict, self.identity_field)
+        return self.rows_index.get(row_dict.get(self.identity_field))
 
     def update_row(self, row_dict):
         if self.no_check:
@@ -89,15 +157,4 @@ class CsvManager:
             self.writer.writerow(row_dict)
 
     def check_row_exist(self, row_dict):
-        if self.no_check:
-            return False
-        else:
-            # start from beginning and skip the header
-            self.csv_file.seek(0)
-            next(self.reader)
-            for row in self.reader:
-                self._fix_row_key_type(row, self.identity_field)
-                self._fix_row_key_type(row_dict, self.identity_field)
-                if row.get(self.identity_field) == row_dict.get(self.identity_field):
-                    return True
-            return False
+        return self.get_row(row_dict) is not None
@@ -0,0 +1,72 @@
+#!/bin/python3.7
+from csv_manager import CsvManager
+import tempfile
+import shutil
+import time
+import sys
+import os
+
+
+fields = [
+    ("id", str),
+    ("link", str),
+    ("category_id", int),
+    ("category", str),
+    ("title", str),
+    ("stop", str),
+    ("price", float),
+    ("flag", int)
+]
+
+
+def make_row(auction_id):
+    return {
+        "id": str(auction_id),
+        "link": "https://aukcje.ideagetin.pl/aukcja/{id}/".format(id=auction_id),
+        "category_id": 3,
+        "category": "przyczepy-naczepy",
+        "title": "Naczepa podkontenerowa {id}".format(id=auction_id),
+        "stop": "Do końca: 5 dni 1 godzina (2021-12-03 14:00:00)",
+        "price": 60300.0 + auction_id,
+        "flag": 0
+    }
+
+
+def write_existing_file(file_name, num_rows):
+    csv_manager = CsvManager(file_name, fields, "id")
+    csv_manager.open_file()
+    for auction_id in range(num_rows):
+        csv_manager.update_row(make_row(auction_id))
+    csv_manager.close_file()
+
+
+def run(existing_rows, crawled_rows, work_dir):
+    file_name = os.path.join(work_dir, "bench_{rows}.csv".format(rows=existing_rows))
+    write_existing_file(file_name, existing_rows)
+
+    t0 = time.perf_counter()
+    csv_manager = CsvManager(file_name, fields, "id")
+    csv_manager.open_file()
+    # half of the crawled auctions already exist in the file, half are new
+    for auction_id in range(existing_rows - crawled_rows // 2, existing_rows + crawled_rows // 2):
+        row = make_row(auction_id)
+        csv_manager.check_row_exist(row)
+        csv_manager.update_row(row)
+    csv_manager.close_file()
+    return time.perf_counter() - t0
+
+
+def main():
+    crawled_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    work_dir = tempfile.mkdtemp()
+    try:
+        print("%12s %12s %10s" % ("existing", "crawled", "seconds"))
+        for existing_rows in (1000, 10000, 50000, 100000):
+            took = run(existing_rows, crawled_rows, work_dir)
+            print("%12d %12d %10.3f" % (existing_rows, crawled_rows, took))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
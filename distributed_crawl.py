@@ -0,0 +1,344 @@
+#!/bin/python3.7
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process
+from ideagetin_crawler import IdeagetinCrawler
+from async_crawler import AsyncCrawler
+from work_queue import WorkQueue
+from storage import Storage
+from snapshot_history import SnapshotHistory
+from incremental_state import IncrementalState
+from util import Util
+import logutil
+import logging
+import argparse
+import asyncio
+import socket
+import time
+import os
+
+
+log = logging.getLogger("distributed_crawl")
+logutil.init_log(log, logging.DEBUG)
+
+
+# Coordinator of a distributed ideagetin crawl: queues the listing pages of every category, queues
+# the auctions the workers found on the listing pages and merges the auctions parsed by the workers
+# into the per category outputs. The outputs have a single writer, the workers only fetch, parse and
+# download images.
+class Coordinator:
+
+    def __init__(self, crawler, work_queue, poll_interval=1.0, progress_interval=10.0, batch_size=100):
+        self.crawler = crawler
+        self.work_queue = work_queue
+        self.poll_interval = poll_interval
+        self.progress_interval = progress_interval
+        self.batch_size = batch_size
+
+        # category => (storage, incremental state, history)
+        self.outputs = dict()
+        self.num_auctions = 0
+
+    async def run(self):
+        self.work_queue.clear()
+
+        cat_max_pages = await self.crawler.get_categories_max_pages()
+        for category, max_pages in cat_max_pages:
+            self.open_output(category)
+            self.work_queue.put_many("listing", [
+                (url, {"category": category, "url": url})
+                for url in (self.crawler.search_link_format.format(category=category, page_number=page_number)
+                            for page_number in range(1, max_pages + 1))])
+        log.info("Queued: %d listing pages of %d categories" %
+                 (sum(max_pages for _, max_pages in cat_max_pages), len(cat_max_pages)))
+
+        last_progress_time = time.time()
+        while True:
+            results = self.work_queue.take_results(self.batch_size)
+            for _, kind, payload, result in results:
+                if kind == "listing":
+                    self.queue_auctions(payload.get("category"), result)
+                else:
+                    self.merge_auction(payload.get("category"), result)
+
+            if results:
+                continue
+
+            # the tasks of a worker which died go back to the queue even when no worker claims
+            self.work_queue.requeue_expired()
+            counts = self.work_queue.counts()
+            if not counts.get("pending") and not counts.get("leased") and not counts.get("done"):
+                break
+            if time.time() - last_progress_time >= self.progress_interval:
+                log.info("Tasks: %s" % counts)
+                last_progress_time = time.time()
+            await asyncio.sleep(self.poll_interval)
+
+        for category in list(self.outputs.keys()):
+            self.close_output(category)
+
+        counts = self.work_queue.counts()
+        log.info("Merged: %d auctions, tasks: %s" % (self.num_auctions, counts))
+        if counts.get("failed"):
+            log.error("Failed tasks: %d, they used up their attempts" % counts.get("failed"))
+        return counts
+
+    def open_output(self, category):
+        output_dir = self.crawler.output_dir_path_format.format(category=category)
+        Util.create_directory(output_dir)
+
+        storage = Storage.create(self.crawler.storage, output_dir, category, self.crawler.fields, "id")
+        storage.open_file()
+
+        incremental_state = IncrementalState(os.path.join(output_dir, ".listing_cache.json"),
+                                             storage, self.crawler.incremental)
+        incremental_state.open()
+
+        history = SnapshotHistory(os.path.join(output_dir, ".history"),
+                                  [field_name for field_name, field_type in self.crawler.fields
+                                   if field_type is float])
+
+        self.outputs[category] = (storage, incremental_state, history)
+
+    def close_output(self, category):
+        storage, incremental_state, history = self.outputs.pop(category)
+        storage.close_file()
+        incremental_state.close()
+        history.close()
+
+    def queue_auctions(self, category, auctions_links):
+        _, incremental_state, _ = self.outputs.get(category)
+        self.work_queue.put_many("auction", [
+            (auction_url, {"category": category, "url": auction_url})
+            for auction_url, signature in auctions_links
+            if incremental_state.need_fetch(self.crawler.get_auction_id(auction_url), signature)])
+
+    def merge_auction(self, category, extracted_data):
+        storage, incremental_state, history = self.outputs.get(category)
+        extracted_data["flag"] = self.crawler.get_flag(storage, extracted_data)
+        storage.update_row(extracted_data)
+        incremental_state.row_written(extracted_data.get("id"))
+        history.append(extracted_data)
+        self.num_auctions += 1
+
+
+# Worker of a distributed ideagetin crawl: claims listing and auction tasks, fetches and parses them
+# and downloads the auction images into the output directory shared with the coordinator.
+# An auction task completes once its images are downloaded, so the task of a worker which died is
+# crawled again by another one. Exits after idle_timeout seconds without any task to claim.
+class Worker:
+
+    def __init__(self, crawler, work_queue, worker_id=None, concurrency=20, claim_size=10,
+                 poll_interval=1.0, idle_timeout=300.0):
+        self.crawler = crawler
+        self.work_queue = work_queue
+        self.worker_id = worker_id or "%s-%d" % (socket.gethostname(), os.getpid())
+        self.concurrency = concurrency
+        self.claim_size = claim_size
+        self.poll_interval = poll_interval
+        # outlives the leases, the tasks of a worker which died are still claimed
+        self.idle_timeout = max(idle_timeout, 2 * work_queue.lease_time)
+
+        # ids of the claimed tasks not finished yet, their leases are renewed
+        self.leased = set()
+        self.num_tasks = 0
+
+        # the work queue calls block, they run on their own thread off the event loop
+        self.queue_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def call_queue(self, method, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.queue_executor, method, *args)
+
+    async def run(self):
+        task_queue = asyncio.Queue(maxsize=self.claim_size)
+        task_workers = AsyncCrawler.start_workers(task_queue, self.process_task, self.concurrency)
+        renewer = asyncio.ensure_future(self.renew_leases())
+
+        idle_since = time.time()
+        try:
+            while True:
+                # claim only when a worker is free, a claimed task is not waiting for a slow worker
+                # while its lease runs out
+                if len(self.leased) >= self.concurrency:
+                    await asyncio.sleep(self.poll_interval / 10)
+                    continue
+                tasks = await self.call_queue(self.work_queue.claim, self.worker_id,
+                                              min(self.claim_size, self.concurrency - len(self.leased)))
+                if not tasks:
+                    if self.leased:
+                        idle_since = time.time()
+                    elif time.time() - idle_since >= self.idle_timeout:
+                        break
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+
+                idle_since = time.time()
+                for task in tasks:
+                    self.leased.add(task[0])
+                    await task_queue.put(task)
+        finally:
+            await AsyncCrawler.stop_workers(task_queue, task_workers)
+            renewer.cancel()
+            try:
+                await renewer
+            except asyncio.CancelledError:
+                pass
+            self.queue_executor.shutdown()
+
+        log.info("Worker %s finished: %d tasks" % (self.worker_id, self.num_tasks))
+
+    async def renew_leases(self):
+        while True:
+            await asyncio.sleep(self.work_queue.lease_time / 3)
+            if self.leased:
+                await self.call_queue(self.work_queue.renew, self.worker_id, list(self.leased))
+
+    async def process_task(self, task):
+        task_id, kind, payload = task
+        result = None
+        try:
+            if kind == "listing":
+                result = await self.crawl_listing(payload.get("url"))
+            else:
+                result = await self.crawl_auction(payload.get("category"), payload.get("url"))
+        finally:
+            # a failed task is handed out again, until it used up its attempts
+            self.leased.discard(task_id)
+            if result is None:
+                await self.call_queue(self.work_queue.release, self.worker_id, task_id)
+            else:
+                await self.call_queue(self.work_queue.complete, task_id, result)
+                self.num_tasks += 1
+
+    async def crawl_listing(self, url):
+        with self.crawler.metrics.timer("fetch"):
+            url, page_content = await self.crawler.extract_async(url)
+        if url is None or page_content is None:
+            return None
+        with self.crawler.metrics.timer("parse_listing"):
+            return await self.crawler.run_parser(self.crawler.parse_search_result_page, page_content)
+
+    async def crawl_auction(self, category, auction_url):
+        images_url = auction_url.replace("aukcja", "zdjecia")
+        with self.crawler.metrics.timer("fetch"):
+            (url, page_content), (_, images_page_content) = await asyncio.gather(
+                self.crawler.extract_async(auction_url), self.crawler.extract_async(images_url))
+        if url is None or page_content is None:
+            log.error("Url or page_content none: %s" % auction_url)
+            return None
+
+        with self.crawler.metrics.timer("parse"):
+            extracted_data = await self.crawler.run_parser(self.crawler.parse_data, category, url, page_content)
+            if images_page_content is not None:
+                images_links = await self.crawler.run_parser(self.crawler.parse_full_images_page,
+                                                             images_page_content)
+                extracted_data["images"] = '|'.join(images_links)
+
+        if extracted_data.get("images") is not None:
+            auction_output_dir = os.path.join(self.crawler.output_dir_path_format.format(category=category),
+                                              extracted_data.get("id"))
+            Util.create_directory(auction_output_dir)
+
+            img_urls = list()
+            downloads = list()
+            for img_url in extracted_data.get("images").split('|'):
+                local_img_file_path = os.path.join(
+                    auction_output_dir,
+                    "{img_id}.jpg".format(img_id=self.crawler.get_image_id(img_url)))
+                if not Util.check_file_exist(local_img_file_path):
+                    img_urls.append(img_url)
+                    downloads.append(self.crawler.download_file(img_url, local_img_file_path))
+
+            # the auction row is kept when images fail, a missing image is fetched by the next crawl of the auction
+            with self.crawler.metrics.timer("download"):
+                results = await asyncio.gather(*downloads)
+            failed_urls = [img_url for img_url, ok in zip(img_urls, results) if not ok]
+            if failed_urls:
+                log.warning("Auction %s: %d of %d images failed: %s" %
+                            (auction_url, len(failed_urls), len(img_urls), ' '.join(failed_urls)))
+
+        return extracted_data
+
+
+def create_crawler(storage="csv", incremental=False, output_dir=None):
+    # the http cache and the blob store keep an index file written by their single owner,
+    # the processes of a distributed crawl would overwrite each other's index
+    crawler = IdeagetinCrawler(http_cache=False, blob_store=False, storage=storage, incremental=incremental)
+    if output_dir is not None:
+        crawler.output_dir_path_format = os.path.join(output_dir, "{category}")
+    return crawler
+
+
+async def run_coordinator(queue, storage="csv", incremental=False, output_dir=None, lease_time=120.0):
+    work_queue = WorkQueue.create(queue, lease_time=lease_time)
+    work_queue.open()
+    try:
+        async with create_crawler(storage, incremental, output_dir) as crawler:
+            return await Coordinator(crawler, work_queue).run()
+    finally:
+        work_queue.close()
+
+
+async def run_worker(queue, output_dir=None, worker_id=None, concurrency=20, idle_timeout=300.0,
+                     lease_time=120.0):
+    work_queue = WorkQueue.create(queue, lease_time=lease_time)
+    work_queue.open()
+    try:
+        async with create_crawler(output_dir=output_dir) as crawler:
+            await Worker(crawler, work_queue, worker_id, concurrency, idle_timeout=idle_timeout).run()
+    finally:
+        work_queue.close()
+
+
+def worker_process(*args):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(run_worker(*args))
+
+
+if __name__ == '__main__':
+    default_queue = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Ideagetin", ".work_queue.sqlite")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("role", choices=["coordinator", "worker"])
+    parser.add_argument("--queue", default=default_queue,
+                        help="sqlite file on storage shared by the hosts, or redis://host:port/db")
+    parser.add_argument("--output-dir", help="directory of the category outputs, shared by the hosts")
+    parser.add_argument("--lease-time", type=float, default=120.0,
+                        help="seconds a claimed task is reserved for its worker")
+    parser.add_argument("--storage", choices=sorted(Storage.backends.keys()), default="csv",
+                        help="where the coordinator stores the auctions")
+    parser.add_argument("--incremental", action="store_true",
+                        help="skip auctions whose listing price and end time did not change")
+    parser.add_argument("--local-workers", type=int, default=0,
+                        help="worker processes started by the coordinator on this host")
+    parser.add_argument("--worker-id", help="name of the worker in the leases, host-pid by default")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="tasks a worker processes at the same time")
+    parser.add_argument("--idle-timeout", type=float, default=300.0,
+                        help="seconds a worker waits for new tasks before exiting, at least twice --lease-time")
+    args = parser.parse_args()
+
+    if args.queue == default_queue:
+        Util.create_directory(os.path.dirname(default_queue))
+
+    t0 = time.time()
+    log.debug("Distributed %s started..." % args.role)
+    loop = asyncio.get_event_loop()
+    if args.role == "coordinator":
+        workers = [Process(target=worker_process,
+                           args=(args.queue, args.output_dir, None, args.concurrency, args.idle_timeout,
+                                 args.lease_time))
+                   for _ in range(args.local_workers)]
+        for worker in workers:
+            worker.start()
+        counts = loop.run_until_complete(run_coordinator(args.queue, args.storage, args.incremental,
+                                                         args.output_dir, args.lease_time))
+        for worker in workers:
+            worker.join()
+        log.debug("Took: %.2f seconds" % (time.time() - t0))
+        if counts.get("failed"):
+            raise SystemExit(1)
+    else:
+        loop.run_until_complete(run_worker(args.queue, args.output_dir, args.worker_id, args.concurrency,
+                                           args.idle_timeout, args.lease_time))
+        log.debug("Took: %.2f seconds" % (time.time() - t0))
@@ -0,0 +1,63 @@
+from tempfile import NamedTemporaryFile
+import logutil
+import logging
+import hashlib
+import json
+import os
+
+
+log = logging.getLogger("fingerprint_cache")
+logutil.init_log(log, logging.DEBUG)
+
+
+# Values kept between runs by key, valid only while the fingerprint of their source is unchanged.
+# Entries not touched during a run are dropped when the cache is saved.
+class FingerprintCache:
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        # key => {"fingerprint", "value"}
+        self.previous_entries = dict()
+        self.entries = dict()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(obj):
+        return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def load(self):
+        if os.path.isfile(self.file_path):
+            try:
+                with open(self.file_path, "r", encoding="utf-8") as cache_file:
+                    self.previous_entries = json.load(cache_file)
+            except ValueError:
+                log.warning("Corrupted cache file: %s, starting empty" % self.file_path)
+                self.previous_entries = dict()
+
+    def save(self):
+        directory = os.path.dirname(self.file_path)
+        with NamedTemporaryFile(mode="w", dir=directory, delete=False, encoding="utf-8") as cache_file:
+            json.dump(self.entries, cache_file)
+        os.replace(cache_file.name, self.file_path)
+
+    def get(self, key, fingerprint):
+        # keys are stored as strings by json
+        key = str(key)
+        entry = self.entries.get(key) or self.previous_entries.get(key)
+        if entry is not None and entry.get("fingerprint") == fingerprint:
+            self.entries[key] = entry
+            self.hits += 1
+            return entry.get("value")
+        self.misses += 1
+        return None
+
+    def keep(self, key):
+        # carry the entry over to this run without using it
+        key = str(key)
+        if key not in self.entries and key in self.previous_entries:
+            self.entries[key] = self.previous_entries.get(key)
+
+    def put(self, key, fingerprint, value):
+        self.entries[str(key)] = {"fingerprint": fingerprint, "value": value}
@@ -0,0 +1,38 @@
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml
+    _default_parser = "lxml"
+except ImportError:
+    _default_parser = "html.parser"
+
+
+class HtmlParser:
+    # lxml is several times faster than the pure python html.parser, fall back to it when not installed
+    parser = _default_parser
+    use_strainers = True
+
+    @staticmethod
+    def id_strainer(name, element_id):
+        return SoupStrainer(name, {"id": element_id})
+
+    @staticmethod
+    def class_strainer(name, *class_names):
+        class_names = set(class_names)
+
+        # bs4 versions differ on whether the class attribute is already split when straining
+        def match_class(value):
+            if value is None:
+                return False
+            if isinstance(value, str):
+                value = value.split()
+            return not class_names.isdisjoint(value)
+
+        return SoupStrainer(name, {"class": match_class})
+
+    @staticmethod
+    def parse(page_content, parse_only=None):
+        # parse_only restricts the tree to the elements matching the strainer (and their children)
+        if not HtmlParser.use_strainers:
+            parse_only = None
+        return BeautifulSoup(page_content, HtmlParser.parser, parse_only=parse_only)
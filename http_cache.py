@@ -0,0 +1,158 @@
+from tempfile import NamedTemporaryFile
+from collections import Counter
+import logutil
+import logging
+import hashlib
+import json
+import time
+import os
+
+
+log = logging.getLogger("http_cache")
+logutil.init_log(log, logging.DEBUG)
+
+
+class HttpCache:
+
+    def __init__(self, cache_dir, max_size=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.index_file_path = os.path.join(cache_dir, "index.json")
+
+        # url => {"etag", "last_modified", "digest", "size", "access_time"}
+        self.index = dict()
+        # digest => number of urls with that body, and the size of the unique bodies
+        self.digest_refs = Counter()
+        self.total_size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def open(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if os.path.isfile(self.index_file_path):
+            try:
+                with open(self.index_file_path, "r", encoding="utf-8") as index_file:
+                    self.index = json.load(index_file)
+            except ValueError:
+                log.warning("Corrupted cache index: %s, starting empty" % self.index_file_path)
+                self.index = dict()
+
+        for entry in self.index.values():
+            self._add_ref(entry)
+
+    def close(self):
+        self._evict(remove_orphans=True)
+        with NamedTemporaryFile(mode="w", dir=self.cache_dir, delete=False, encoding="utf-8") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(index_file.name, self.index_file_path)
+
+        log.debug("Http cache hits: %d, misses: %d, evictions: %d, entries: %d" %
+                  (self.hits, self.misses, self.evictions, len(self.index)))
+
+    def _body_path(self, digest):
+        # shard the bodies so no directory gets too many entries
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def request_headers(self, url):
+        entry = self.index.get(url)
+        if entry is None or not os.path.isfile(self._body_path(entry.get("digest"))):
+            return None
+
+        headers = dict()
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry.get("etag")
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry.get("last_modified")
+        return headers
+
+    def get(self, url):
+        # called on 304 Not Modified
+        entry = self.index.get(url)
+        if entry is None:
+            return None
+        try:
+            with open(self._body_path(entry.get("digest")), "rb") as body_file:
+                body = body_file.read()
+        except FileNotFoundError:
+            self._drop_entry(url)
+            return None
+
+        entry["access_time"] = time.time()
+        self.hits += 1
+        return body
+
+    def put(self, url, headers, body):
+        self.misses += 1
+
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not etag and not last_modified:
+            # without validators there is nothing to revalidate against
+            self._drop_entry(url)
+            return
+
+        digest = hashlib.sha256(body).hexdigest()
+        body_path = self._body_path(digest)
+        if not os.path.isfile(body_path):
+            os.makedirs(os.path.dirname(body_path), exist_ok=True)
+            with NamedTemporaryFile(mode="wb", dir=os.path.dirname(body_path), delete=False) as body_file:
+                body_file.write(body)
+            os.replace(body_file.name, body_path)
+
+        entry = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "digest": digest,
+            "size": len(body),
+            "access_time": time.time()
+        }
+        # referenced before the previous body of the url is released, so an unchanged body is kept
+        self._add_ref(entry)
+        self._drop_entry(url)
+        self.index[url] = entry
+
+        if self.total_size > self.max_size:
+            self._evict()
+
+    def _add_ref(self, entry):
+        digest = entry.get("digest")
+        if self.digest_refs[digest] == 0:
+            self.total_size += entry.get("size")
+        self.digest_refs[digest] += 1
+
+    def _drop_entry(self, url):
+        # the body file is removed with the last url pointing to it
+        entry = self.index.pop(url, None)
+        if entry is None:
+            return
+        digest = entry.get("digest")
+        self.digest_refs[digest] -= 1
+        if self.digest_refs[digest] <= 0:
+            del self.digest_refs[digest]
+            self.total_size -= entry.get("size")
+            try:
+                os.remove(self._body_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self, remove_orphans=False):
+        # least recently used urls are dropped until the unique bodies fit in 90% of max_size,
+        # so a full cache is not sorted again on every put
+        if self.total_size > self.max_size:
+            low_watermark = self.max_size * 0.9
+            for url, _ in sorted(self.index.items(), key=lambda item: item[1].get("access_time")):
+                if self.total_size <= low_watermark:
+                    break
+                self._drop_entry(url)
+                self.evictions += 1
+
+        if remove_orphans:
+            # bodies no url points to, left by a run which was killed before saving its index
+            for shard in os.scandir(self.cache_dir):
+                if not shard.is_dir():
+                    continue
+                for body in os.scandir(shard.path):
+                    if body.name not in self.digest_refs:
+                        os.remove(body.path)
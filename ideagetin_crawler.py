@@ -1,11 +1,16 @@
 #!/bin/python3.7
 from urllib.parse import urlparse
 from async_crawler import AsyncCrawler
-from csv_manager import CsvManager
+from storage import Storage
+from snapshot_history import SnapshotHistory
+from incremental_state import IncrementalState
+from image_manifest import ImageManifest
+from crawl_checkpoint import CrawlCheckpoint
 from util import Util
-from bs4 import BeautifulSoup
+from html_parser import HtmlParser
 import logutil
 import logging
+import argparse
 import asyncio
 import time
 import ssl
@@ -43,11 +48,29 @@ _translate = {
 log = logging.getLogger(__file__)
 logutil.init_log(log, logging.DEBUG)
 
+# parse only the parts of the pages the crawler reads
+_pagination_strainer = HtmlParser.class_strainer("div", "pagination")
+_listing_strainer = HtmlParser.id_strainer("div", "listing-desktop")
+_images_strainer = HtmlParser.class_strainer("div", "bottom-images")
+_auction_strainer = HtmlParser.class_strainer(
+    "div", "boxes", "auction-information", "data-inner", "quartet", "full", "price")
+
 
 class IdeagetinCrawler(AsyncCrawler):
 
-    def __init__(self, max_concurrency=200):
-        AsyncCrawler.__init__(self, max_concurrency)
+    def __init__(self, max_concurrency=200, http_cache=True, parse_workers=None, incremental=False,
+                 storage="csv", blob_store=True, metrics_file=None, prometheus_file=None,
+                 semaphore=None, resume=False):
+        cache_dir = None
+        if http_cache:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Ideagetin", ".http_cache")
+        # images are deduplicated in a store shared by all crawlers and categories
+        blob_store_dir = None
+        if blob_store:
+            blob_store_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".blobs")
+        AsyncCrawler.__init__(self, max_concurrency, cache_dir=cache_dir, parse_workers=parse_workers,
+                              blob_store_dir=blob_store_dir, metrics_file=metrics_file,
+                              prometheus_file=prometheus_file, semaphore=semaphore)
 
         self.site_url = "https://aukcje.ideagetin.pl"
         self.search_link_format = "https://aukcje.ideagetin.pl/aukcje/{category}/widok-lista/strona-{page_number}"
@@ -99,7 +122,33 @@ class IdeagetinCrawler(AsyncCrawler):
 
         self.field_names = [field_name for field_name, _ in self.fields]
 
+        # number of concurrent workers of each crawl_pages pipeline stage
+        self.pipeline_workers = {
+            "detail": 20,
+            "parse": parse_workers or 2,
+            # csv writes are not concurrent safe, keep a single writer
+            "write": 1,
+            "download": 40
+        }
+        self.pipeline_queue_size = 100
+
+        # skip the detail pages of auctions whose listing price and end time did not change
+        self.incremental = incremental
+
+        # "csv" or "sqlite", see Storage.backends
+        self.storage = storage
+
+        # continue from the checkpoint of an interrupted run
+        self.resume = resume
+
     async def start(self):
+        cat_max_pages = await self.get_categories_max_pages()
+
+        tasks = (self.crawl_pages(cat, max_page) for cat, max_page in cat_max_pages)
+        for page in AsyncCrawler.limited_as_completed(tasks):
+            await page
+
+    async def get_categories_max_pages(self):
         first_pages = [
             self.search_link_format.format(category=category, page_number=1)
             for category in self.categories.keys()
@@ -113,7 +162,7 @@ class IdeagetinCrawler(AsyncCrawler):
 
             # Get max pages for this category
             max_page = 1
-            soup = BeautifulSoup(page_content, 'html.parser')
+            soup = HtmlParser.parse(page_content, _pagination_strainer)
             pagination = soup.find("div", {"class": "pagination"})
             if pagination is not None:
 
@@ -128,94 +177,158 @@ class IdeagetinCrawler(AsyncCrawler):
             # await self.crawl_pages(category, max_page)
             cat_max_pages.append((category, max_page))
 
-        tasks = (self.crawl_pages(cat, max_page) for cat, max_page in cat_max_pages)
-        for page in AsyncCrawler.limited_as_completed(tasks):
-            await page
+        return cat_max_pages
 
     async def crawl_pages(self, category, max_pages):
-        pages = (self.search_link_format.format(category=category, page_number=page_number)
-                 for page_number in range(1, max_pages + 1))
-
-        auctions_links = list()
-
-        tasks = (self.extract_async(url) for url in pages)
-        for page in AsyncCrawler.limited_as_completed(tasks, 5):
-            url, page_content = await page
-            if url is not None and page_content is not None:
-                auctions_links.extend(self.parse_search_result_page(page_content))
-
-        if not auctions_links:
-            log.warning("No results found for category: %s" % category)
-            return
-
-        log.debug("Found: %d auctions in %d pages of category: %s" % (len(auctions_links), max_pages, category))
-        
         output_dir = self.output_dir_path_format.format(category=category)
-        csv_file_path = os.path.join(output_dir, "{category}.csv".format(category=category))
 
         Util.create_directory(output_dir)
 
-        csv_manager = CsvManager(csv_file_path, self.fields, "id")
-        csv_manager.open_file()
-
-        '''
-        tasks = (self.extract_multi_async([url.replace("aukcja", "zdjecia"), url]) for url in auctions_links)
-        for pages in AsyncCrawler.limited_as_completed(tasks):
-            results = await pages
-            images_url, images_page_content = results[0]
-            url, page_content = results[1]
-        '''
-        tasks = (self.extract_async(url) for url in auctions_links)
-        for page in AsyncCrawler.limited_as_completed(tasks, 5):
-            url, page_content = await page
-            if url is not None and page_content is not None:
-                extracted_data = self.parse_data(category, url, page_content)
-
-                images_links = list()
-                images_url = url.replace("aukcja", "zdjecia")
-                _, images_page_content = await self.extract_async(images_url)
-                if images_url is not None and images_page_content is not None:
-                    images_links = self.parse_full_images_page(images_page_content)
-                    extracted_data["images"] = '|'.join(images_links)
-
-                if csv_manager.check_row_exist(extracted_data):
-                    if _translate.get("finished") in extracted_data.get("stop").lower():
-                        extracted_data["flag"] = self.flags.get("sold")
-                    else:
-                        extracted_data["flag"] = self.flags.get("updated")
-                else:
-                    extracted_data["flag"] = self.flags.get("new")
-
-                csv_manager.update_row(extracted_data)
-                # log.debug(extracted_data)
-
-                auction_output_dir = os.path.join(output_dir, extracted_data.get("id"))
-                # log.debug(auction_output_dir)
-                Util.create_directory(auction_output_dir)
-
-                if extracted_data.get("images") is not None:
-                    images_urls = extracted_data.get("images").split('|')
-
-                    local_img = list()
-
-                    for img_url in images_urls:
-                        local_img_file_path = os.path.join(
-                            auction_output_dir,
-                            "{img_id}.jpg".format(img_id=self.get_image_id(img_url)))
-
+        storage = Storage.create(self.storage, output_dir, category, self.fields, "id")
 
-                        if not Util.check_file_exist(local_img_file_path):
-                            local_img.append((img_url, local_img_file_path))
+        # written listing pages, auctions and pending images, so an interrupted run can be resumed
+        checkpoint = CrawlCheckpoint(os.path.join(output_dir, ".checkpoint.jsonl"), storage, self.resume)
+        checkpoint.open()
 
-                    download_tasks = (self.download_file(img_url, img_file_path)
-                                      for img_url, img_file_path in local_img)
-
-                    for r in AsyncCrawler.limited_as_completed(download_tasks):
-                        await r
+        storage.open_file(self.resume, checkpoint.auctions_done)
 
+        pages = (self.search_link_format.format(category=category, page_number=page_number)
+                 for page_number in range(1, max_pages + 1))
+        pages = (url for url in pages if not checkpoint.is_page_done(url))
+
+        incremental_state = IncrementalState(os.path.join(output_dir, ".listing_cache.json"),
+                                             storage, self.incremental)
+        incremental_state.open()
+
+        # price fields of every written row are appended to the price history of the category
+        history = SnapshotHistory(os.path.join(output_dir, ".history"),
+                                  [field_name for field_name, field_type in self.fields if field_type is float])
+
+        # downloaded images are listed once up front instead of a stat call per image
+        image_manifest = ImageManifest(output_dir)
+        image_manifest.load()
+
+        # listing -> detail + images page -> parse -> csv write -> image download,
+        # every stage has its own bounded queue and worker pool
+        detail_queue = asyncio.Queue(maxsize=self.pipeline_queue_size)
+        parse_queue = asyncio.Queue(maxsize=self.pipeline_queue_size)
+        write_queue = asyncio.Queue(maxsize=self.pipeline_queue_size)
+        download_queue = asyncio.Queue(maxsize=self.pipeline_queue_size)
+
+        async def fetch_details(auction_url):
+            images_url = auction_url.replace("aukcja", "zdjecia")
+            with self.metrics.timer("fetch"):
+                (url, page_content), (_, images_page_content) = await asyncio.gather(
+                    self.extract_async(auction_url), self.extract_async(images_url))
+            if url is not None and page_content is not None:
+                await parse_queue.put((url, page_content, images_page_content))
+            else:
+                log.error("Url or page_content none: %s" % auction_url)
+
+        async def parse_details(fetched):
+            url, page_content, images_page_content = fetched
+            with self.metrics.timer("parse"):
+                extracted_data = await self.run_parser(self.parse_data, category, url, page_content)
+                if images_page_content is not None:
+                    images_links = await self.run_parser(self.parse_full_images_page, images_page_content)
+                    extracted_data["images"] = '|'.join(images_links)
+            await write_queue.put(extracted_data)
+
+        async def write_row(extracted_data):
+            with self.metrics.timer("write"):
+                extracted_data["flag"] = self.get_flag(storage, extracted_data)
+                storage.update_row(extracted_data)
+                incremental_state.row_written(extracted_data.get("id"))
+                history.append(extracted_data)
+
+            auction_output_dir = os.path.join(output_dir, extracted_data.get("id"))
+            image_manifest.create_directory(auction_output_dir)
+
+            if extracted_data.get("images") is not None:
+                for img_url in extracted_data.get("images").split('|'):
+                    local_img_file_path = os.path.join(
+                        auction_output_dir,
+                        "{img_id}.jpg".format(img_id=self.get_image_id(img_url)))
+
+                    if not image_manifest.check_file_exist(local_img_file_path):
+                        checkpoint.image_queued(img_url, local_img_file_path)
+                        await download_queue.put((img_url, local_img_file_path))
+
+            # after its images are recorded, so none is lost when the run stops here
+            checkpoint.auction_done(extracted_data.get("id"))
+
+        async def download_image(download):
+            img_url, img_file_path = download
+            with self.metrics.timer("download"):
+                if await self.download_file(img_url, img_file_path):
+                    checkpoint.image_done(img_file_path)
+
+        detail_workers = AsyncCrawler.start_workers(
+            detail_queue, fetch_details, self.pipeline_workers.get("detail"))
+        parse_workers = AsyncCrawler.start_workers(
+            parse_queue, parse_details, self.pipeline_workers.get("parse"))
+        write_workers = AsyncCrawler.start_workers(
+            write_queue, write_row, self.pipeline_workers.get("write"))
+        download_workers = AsyncCrawler.start_workers(
+            download_queue, download_image, self.pipeline_workers.get("download"))
+
+        completed = False
+        try:
+            # images the interrupted run did not download
+            for img_file_path, img_url in checkpoint.pending_images.items():
+                if not image_manifest.check_file_exist(img_file_path):
+                    image_manifest.create_directory(os.path.dirname(img_file_path))
+                    await download_queue.put((img_url, img_file_path))
+
+            num_auctions = 0
+            tasks = (self.extract_async(url) for url in pages)
+            for page in AsyncCrawler.limited_as_completed(tasks, 5):
+                url, page_content = await page
+                if url is not None and page_content is not None:
+                    with self.metrics.timer("parse_listing"):
+                        auctions_links = await self.run_parser(self.parse_search_result_page, page_content)
+                    checkpoint.page_listed(url, [self.get_auction_id(auction_url) for auction_url, _ in auctions_links])
+                    for auction_url, signature in auctions_links:
+                        num_auctions += 1
+                        auction_id = self.get_auction_id(auction_url)
+                        if checkpoint.is_auction_done(auction_id):
+                            continue
+                        if incremental_state.need_fetch(auction_id, signature):
+                            await detail_queue.put(auction_url)
+                        else:
+                            checkpoint.auction_done(auction_id)
+
+            if not num_auctions:
+                log.warning("No results found for category: %s" % category)
             else:
-                logging.error("Url or page_content none: %s" % url)
-        csv_manager.close_file()
+                log.debug("Found: %d auctions in %d pages of category: %s" % (num_auctions, max_pages, category))
+            completed = True
+        finally:
+            # the queued work is finished and the outputs closed when the listing fails too
+            await AsyncCrawler.stop_workers(detail_queue, detail_workers)
+            await AsyncCrawler.stop_workers(parse_queue, parse_workers)
+            await AsyncCrawler.stop_workers(write_queue, write_workers)
+            await AsyncCrawler.stop_workers(download_queue, download_workers)
+
+            if not completed:
+                checkpoint.interrupt()
+            storage.close_file()
+            incremental_state.close()
+            history.close()
+            image_manifest.close()
+            if completed:
+                checkpoint.close()
+
+    def get_flag(self, storage, extracted_data):
+        if storage.check_row_exist(extracted_data):
+            if _translate.get("finished") in extracted_data.get("stop").lower():
+                return self.flags.get("sold")
+            return self.flags.get("updated")
+        return self.flags.get("new")
+
+    @staticmethod
+    def get_auction_id(auction_url):
+        return urlparse(auction_url).path.split('/')[2]
 
     @staticmethod
     def get_image_id(img_url):
@@ -225,7 +338,7 @@ class IdeagetinCrawler(AsyncCrawler):
 
     def parse_search_result_page(self, page_content):
         auctions_links = list()
-        soup = BeautifulSoup(page_content, 'html.parser')
+        soup = HtmlParser.parse(page_content, _listing_strainer)
         l1 = soup.find("div", {"id": "listing-desktop"})
         # l2 = soup.find("div", {"id": "listing-mobile"})
 
@@ -235,27 +348,40 @@ class IdeagetinCrawler(AsyncCrawler):
             if left_pic_div is not None:
                 res_uri = left_pic_div.find("a").get("href")
                 auction_page_url = self.site_url + res_uri
-                auctions_links.append(auction_page_url)
+                auctions_links.append((auction_page_url, self.parse_listing_signature(r)))
 
         return auctions_links
 
+    @staticmethod
+    def parse_listing_signature(auction_div):
+        # price, end date and finished marker shown on the listing, the countdown text changes on every run
+        signature = list()
+        price = auction_div.find("span", {"class": "numbers"})
+        if price is not None:
+            signature.append(price.text.strip())
+        end_time = re.search("[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}(:[0-9]{2})?", auction_div.text)
+        if end_time is not None:
+            signature.append(end_time.group(0))
+        if signature:
+            # an auction closing early keeps its price and end date, its flag has to be updated
+            signature.append(_translate.get("finished") in auction_div.text.lower())
+        return signature
+
     def parse_full_images_page(self, page_content):
         full_images = list()
-        images_soup = BeautifulSoup(page_content, 'html.parser')
+        images_soup = HtmlParser.parse(page_content, _images_strainer)
         for a in images_soup.find("div", {"class": "bottom-images"}).findAll("a"):
             full_images.append(self.site_url + '/' + a.get("href"))
         return full_images
 
     def parse_data(self, category, page_url, page_content):
-        auction_id = urlparse(page_url).path.split('/')[2]
+        auction_id = self.get_auction_id(page_url)
 
-        auction_soup = BeautifulSoup(page_content, 'html.parser')
+        auction_soup = HtmlParser.parse(page_content, _auction_strainer)
 
-        auction_content = auction_soup.find("div", {"class": "auction-content"})
         auction_content_top_bar = auction_soup.find("div", {"class": "left boxes"}).find("div", {"class": "top-bar"})
 
         auction_title = auction_content_top_bar.find("h1").text.strip()
-        auction_info = auction_content_top_bar.find("div", {"class": "auction-information"}).find("p").text.strip()
 
         extracted_data = dict()
         extracted_data["id"] = auction_id
@@ -299,10 +425,11 @@ class IdeagetinCrawler(AsyncCrawler):
         parameters_dict = dict()
 
         for data in auction_soup.findAll("div", {"class": "data-inner"}):
+            data_text = data.text.lower()
             for field in parameters:
                 translate = _translate.get(field)
-                if translate and translate in data.text.lower():
-                    parameters_dict[translate] = data.text.lower().replace(translate + ":", '').strip()
+                if translate and translate in data_text:
+                    parameters_dict[translate] = data_text.replace(translate + ":", '').strip()
 
         # Check equipment
         parameters_dict[_translate.get("equipment")] = list()
@@ -316,13 +443,15 @@ class IdeagetinCrawler(AsyncCrawler):
         description = ''
         description_div = auction_soup.find("div", {"class": "full"})
         if description_div is not None:
-            if description_div.find("p"):
-                description = description_div.find("p").text.strip()
+            description_p = description_div.find("p")
+            if description_p:
+                description = description_p.text.strip()
 
         extracted_data["description"] = description
 
-        price_num = auction_soup.find("div", {"class": "price"}).find("span", {"class": "numbers"}).text.strip()
-        span_currency = auction_soup.find("div", {"class": "price"}).find("span", {"class": "currency"})
+        price_div = auction_soup.find("div", {"class": "price"})
+        price_num = price_div.find("span", {"class": "numbers"}).text.strip()
+        span_currency = price_div.find("span", {"class": "currency"})
         price_currency_smaller = span_currency.find("span", {"class": "smaller"}).text
         price_currency = span_currency.text.replace(price_currency_smaller, '')
 
@@ -333,15 +462,28 @@ class IdeagetinCrawler(AsyncCrawler):
         return extracted_data
 
 
-async def main():
-    async with IdeagetinCrawler() as ideagetin_crawl:
+async def main(incremental=False, storage="csv", metrics_file=None, prometheus_file=None, resume=False):
+    async with IdeagetinCrawler(incremental=incremental, storage=storage, metrics_file=metrics_file,
+                                prometheus_file=prometheus_file, resume=resume) as ideagetin_crawl:
         await ideagetin_crawl.start()
         #await ideagetin_crawl.extract_async("https://www.example.com")
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true",
+                        help="skip auctions whose listing price and end time did not change")
+    parser.add_argument("--storage", choices=sorted(Storage.backends.keys()), default="csv",
+                        help="where the auctions are stored")
+    parser.add_argument("--metrics-file", help="write the json crawl metrics summary to this file")
+    parser.add_argument("--prometheus-file", help="write the crawl metrics in prometheus text format to this file")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the interrupted run from its checkpoint")
+    args = parser.parse_args()
+
     t0 = time.time()
     log.debug("Crawler started...")
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    loop.run_until_complete(main(args.incremental, args.storage, args.metrics_file, args.prometheus_file,
+                                 args.resume))
     log.debug("Took: %.2f seconds" % (time.time() - t0))
@@ -0,0 +1,58 @@
+from util import Util
+import logutil
+import logging
+import os
+
+
+log = logging.getLogger("image_manifest")
+logutil.init_log(log, logging.DEBUG)
+
+
+# Images already downloaded in a category, listed once per directory at the start of the run,
+# so the per image existence checks and per auction directory creation are answered from memory
+# instead of a stat / mkdir syscall each.
+class ImageManifest:
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+
+        # auction directory path => names of the files in it
+        self.directories = dict()
+
+        self.directories_scanned = 0
+        self.stat_calls_avoided = 0
+        self.mkdir_calls_avoided = 0
+
+    def load(self):
+        self.directories = dict()
+        try:
+            with os.scandir(self.output_dir) as entries:
+                auction_dirs = [entry.path for entry in entries
+                                if not entry.name.startswith(".") and entry.is_dir()]
+        except FileNotFoundError:
+            return
+        self.directories_scanned += 1
+
+        for auction_dir in auction_dirs:
+            with os.scandir(auction_dir) as entries:
+                # partial downloads are not images yet
+                self.directories[auction_dir] = set(entry.name for entry in entries
+                                                    if not entry.name.endswith(".part"))
+            self.directories_scanned += 1
+
+    def close(self):
+        log.debug("Directories scanned: %d, stat calls avoided: %d, mkdir calls avoided: %d (%s)" %
+                  (self.directories_scanned, self.stat_calls_avoided, self.mkdir_calls_avoided,
+                   self.output_dir))
+
+    def create_directory(self, dir_path):
+        if dir_path in self.directories:
+            self.mkdir_calls_avoided += 1
+            return
+        Util.create_directory(dir_path)
+        self.directories[dir_path] = set()
+
+    def check_file_exist(self, file_path):
+        dir_path, file_name = os.path.split(file_path)
+        self.stat_calls_avoided += 1
+        return file_name in self.directories.get(dir_path, ())
@@ -0,0 +1,56 @@
+from fingerprint_cache import FingerprintCache
+import logutil
+import logging
+
+
+log = logging.getLogger("incremental_state")
+logutil.init_log(log, logging.DEBUG)
+
+
+# Decides from the listing level data of an auction (price, end time, ...) and the previous stored
+# state whether its detail pages need to be fetched again. The listing signatures are always
+# recorded, auctions are only skipped when enabled.
+class IncrementalState:
+
+    def __init__(self, file_path, storage, enabled=False):
+        self.listing_cache = FingerprintCache(file_path)
+        self.storage = storage
+        self.enabled = enabled
+
+        # auction id => listing fingerprint, until the auction row is written
+        self.pending = dict()
+
+        self.skipped = 0
+        self.fetched = 0
+
+    def open(self):
+        self.listing_cache.load()
+
+    def close(self):
+        self.listing_cache.save()
+        if self.enabled:
+            log.debug("Unchanged auctions skipped: %d, fetched: %d (%s)" %
+                      (self.skipped, self.fetched, self.listing_cache.file_path))
+
+    def need_fetch(self, auction_id, signature):
+        auction_id = str(auction_id)
+        if not signature:
+            # nothing on the listing to compare with
+            self.fetched += 1
+            return True
+
+        fingerprint = FingerprintCache.fingerprint(signature)
+        if self.enabled and \
+                self.storage.check_row_exist({self.storage.identity_field: auction_id}) and \
+                self.listing_cache.get(auction_id, fingerprint) is not None:
+            self.skipped += 1
+            return False
+
+        self.pending[auction_id] = fingerprint
+        self.fetched += 1
+        return True
+
+    def row_written(self, auction_id):
+        fingerprint = self.pending.pop(str(auction_id), None)
+        if fingerprint is not None:
+            self.listing_cache.put(auction_id, fingerprint, True)
@@ -0,0 +1,67 @@
+#!/bin/python3.7
+from async_crawler import AsyncCrawler
+from itertools import islice
+import asyncio
+import random
+import time
+import sys
+
+
+def polling_limited_as_completed(coroutines, limit=1):
+    # previous busy-polling implementation of AsyncCrawler.limited_as_completed, kept for comparison
+    futures = [asyncio.ensure_future(c) for c in islice(coroutines, 0, limit)]
+
+    async def first_to_finish():
+        while True:
+            await asyncio.sleep(0)
+            for f in futures:
+                if f.done():
+                    futures.remove(f)
+                    try:
+                        new_future = next(coroutines)
+                        futures.append(asyncio.ensure_future(new_future))
+                    except StopIteration as e:
+                        pass
+                    return f.result()
+
+    while len(futures) > 0:
+        yield first_to_finish()
+
+
+async def synthetic_task(i):
+    await asyncio.sleep(random.uniform(0, 0.01))
+    return i
+
+
+async def run(scheduler, num_tasks, limit):
+    tasks = (synthetic_task(i) for i in range(num_tasks))
+    results = 0
+    for res in scheduler(tasks, limit):
+        await res
+        results += 1
+    assert results == num_tasks
+
+
+def measure(scheduler, num_tasks, limit):
+    loop = asyncio.new_event_loop()
+    try:
+        random.seed(0)
+        wall_t0, cpu_t0 = time.perf_counter(), time.process_time()
+        loop.run_until_complete(run(scheduler, num_tasks, limit))
+        return time.perf_counter() - wall_t0, time.process_time() - cpu_t0
+    finally:
+        loop.close()
+
+
+def main():
+    num_tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print("%-10s %6s %10s %10s" % ("scheduler", "limit", "wall [s]", "cpu [s]"))
+    for limit in (50, 200, 1000):
+        for name, scheduler in (("polling", polling_limited_as_completed),
+                                ("event", AsyncCrawler.limited_as_completed)):
+            wall, cpu = measure(scheduler, num_tasks, limit)
+            print("%-10s %6d %10.3f %10.3f" % (name, limit, wall, cpu))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,17 @@
 #!/bin/python3.7
 from async_crawler import AsyncCrawler
-from csv_manager import CsvManager
+from storage import Storage
+from snapshot_history import SnapshotHistory
+from fingerprint_cache import FingerprintCache
+from incremental_state import IncrementalState
+from image_manifest import ImageManifest
+from crawl_checkpoint import CrawlCheckpoint
 from util import Util
 from datetime import datetime
 from pytz import timezone
 import logutil
 import logging
+import argparse
 import asyncio
 import json
 import time
@@ -19,8 +25,19 @@ logutil.init_log(log, logging.DEBUG)
 
 class MleasingCrawler(AsyncCrawler):
 
-    def __init__(self, max_concurrency=200):
-        AsyncCrawler.__init__(self, max_concurrency)
+    def __init__(self, max_concurrency=200, http_cache=True, incremental=False,
+                 storage="csv", blob_store=True, metrics_file=None, prometheus_file=None,
+                 semaphore=None, resume=False):
+        cache_dir = None
+        if http_cache:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Mleasing", ".http_cache")
+        # images are deduplicated in a store shared by all crawlers and categories
+        blob_store_dir = None
+        if blob_store:
+            blob_store_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".blobs")
+        AsyncCrawler.__init__(self, max_concurrency, cache_dir=cache_dir,
+                              blob_store_dir=blob_store_dir, metrics_file=metrics_file,
+                              prometheus_file=prometheus_file, semaphore=semaphore)
 
         self.site_url = "https://portalaukcyjny.mleasing.pl/"
         self.offer_url_format = "https://portalaukcyjny.mleasing.pl/#/offer/{offer_id}/details"
@@ -101,79 +118,238 @@ class MleasingCrawler(AsyncCrawler):
 
         self.field_names = [field_name for field_name, _ in self.fields]
 
+        # offers per search api request and search requests running at once
+        self.search_page_size = 50
+        self.search_pages_in_flight = 5
+
+        # number of concurrent workers of each crawl_pages pipeline stage
+        self.pipeline_workers = {
+            # get-images api lookups, independent of the search paging
+            "images": 10,
+            # csv writes are not concurrent safe, keep a single writer
+            "write": 1,
+            "download": 40
+        }
+        self.pipeline_queue_size = 100
+
+        # skip the offers whose price and end time in the search results did not change
+        self.incremental = incremental
+
+        # "csv" or "sqlite", see Storage.backends
+        self.storage = storage
+
+        # continue from the checkpoint of an interrupted run
+        self.resume = resume
+
     async def start(self):
         tasks = (self.crawl_pages(category) for category in self.categories)
         for res in AsyncCrawler.limited_as_completed(tasks):
             await res
 
-    async def crawl_pages(self, category):
-        cat_id = self.categories.get(category)
-        offset = 0
-        max_results = 50
-        auctions = list()
-
-        while True:
-            url = self.search_category_url_format.format(cat_id=cat_id, skip=offset, max_num_of_results=max_results)
-            _, page_content = await self.extract_async(url)
-            if page_content is not None:
-                json_obj = json.loads(page_content.decode("utf-8"), encoding="utf-8")
+    async def search_page(self, cat_id, offset):
+        url = self.search_category_url_format.format(
+            cat_id=cat_id, skip=offset, max_num_of_results=self.search_page_size)
+        _, page_content = await self.extract_async(url)
+        if page_content is None:
+            log.error("Search page failed: %s" % url)
+            return None
+        return json.loads(page_content.decode("utf-8"))
 
+    @staticmethod
+    def get_total_count(json_obj):
+        # the search api is not known to return a total count, these are the usual names of one;
+        # without it the windowed paging of search_items is the normal path
+        for key in ("TotalCount", "Count", "Total", "@odata.count"):
+            if isinstance(json_obj.get(key), int):
+                return json_obj.get(key)
+        return None
+
+    async def search_items(self, category):
+        # Yields the items of every search page as it arrives. The first page tells the total count,
+        # the remaining offset windows are then requested concurrently.
+        cat_id = self.categories.get(category)
+        page_size = self.search_page_size
+
+        json_obj = await self.search_page(cat_id, 0)
+        if json_obj is None:
+            return
+        items = json_obj.get("Items")
+        yield items
+        if len(items) < page_size:
+            return
+
+        total_count = self.get_total_count(json_obj)
+        if total_count is not None:
+            tasks = (self.search_page(cat_id, offset) for offset in range(page_size, total_count, page_size))
+            for res in AsyncCrawler.limited_as_completed(tasks, self.search_pages_in_flight):
+                json_obj = await res
+                if json_obj is not None:
+                    yield json_obj.get("Items")
+            return
+
+        # no total count in the response, request windows of pages until one comes back short,
+        # a failed page (after the retries of extract_async) is skipped, it does not end the category
+        offset = page_size
+        last_page = False
+        while not last_page:
+            offsets = range(offset, offset + page_size * self.search_pages_in_flight, page_size)
+            json_objs = await asyncio.gather(*(self.search_page(cat_id, o) for o in offsets))
+            if all(json_obj is None for json_obj in json_objs):
+                # nothing tells where the category ends
+                log.error("Search of category %s stopped at offset %d, every page of the window failed" %
+                          (category, offset))
+                return
+            for page_offset, json_obj in zip(offsets, json_objs):
+                if json_obj is None:
+                    log.warning("Search page of category %s skipped: offset %d" % (category, page_offset))
+                    continue
                 items = json_obj.get("Items")
-                auctions.extend(items)
+                if len(items) < page_size:
+                    last_page = True
+                yield items
+            offset += page_size * self.search_pages_in_flight
 
-            offset += max_results
+    async def crawl_pages(self, category):
+        output_dir = self.output_dir_path_format.format(category=category)
 
-            if len(items) < max_results:
-                break
+        Util.create_directory(output_dir)
 
-        log.debug("Found: %d auctions of category: %s" % (len(auctions), category))
+        storage = Storage.create(self.storage, output_dir, category, self.fields, "id")
+        log.info("Output directory path: %s, storage file: %s" % (output_dir, storage.file_name))
 
-        output_dir = self.output_dir_path_format.format(category=category)
-        csv_file_path = os.path.join(output_dir, "{category}.csv".format(category=category))
+        # written offers and pending images, so an interrupted run can be resumed, the search
+        # windows are cheap and always requested again
+        checkpoint = CrawlCheckpoint(os.path.join(output_dir, ".checkpoint.jsonl"), storage, self.resume)
+        checkpoint.open()
 
-        log.info("Csv output directory path: %s, csv file: %s" % (output_dir, csv_file_path))
+        storage.open_file(self.resume, checkpoint.auctions_done)
 
-        Util.create_directory(output_dir)
+        # offer id => image urls, reused across runs while the search item of the offer is unchanged
+        images_cache = FingerprintCache(os.path.join(output_dir, ".images_cache.json"))
+        images_cache.load()
 
-        csv_manager = CsvManager(csv_file_path, self.fields, "id")
-        csv_manager.open_file()
+        incremental_state = IncrementalState(os.path.join(output_dir, ".listing_cache.json"),
+                                             storage, self.incremental)
+        incremental_state.open()
 
-        tasks = (self.parse_item(category, item) for item in items)
-        for res in AsyncCrawler.limited_as_completed(tasks, 5):
-            extracted_data = await res
+        # price fields of every written row are appended to the price history of the category
+        history = SnapshotHistory(os.path.join(output_dir, ".history"),
+                                  [field_name for field_name, field_type in self.fields if field_type is float])
 
-            if csv_manager.check_row_exist(extracted_data):
-                extracted_data["flag"] = self.flags.get("updated")
-            else:
-                extracted_data["flag"] = self.flags.get("new")
+        # downloaded images are listed once up front instead of a stat call per image
+        image_manifest = ImageManifest(output_dir)
+        image_manifest.load()
 
-            csv_manager.update_row(extracted_data)
+        # search page items -> get-images lookup -> csv write -> image download,
+        # lookups start as soon as a search page arrives
+        item_queue = asyncio.Queue(maxsize=self.pipeline_queue_size)
+        write_queue = asyncio.Queue(maxsize=self.pipeline_queue_size)
+        download_queue = asyncio.Queue(maxsize=self.pipeline_queue_size)
 
-            auction_output_dir = os.path.join(output_dir, extracted_data.get("id"))
-            Util.create_directory(auction_output_dir)
+        seen_offers = set()
 
-            if extracted_data.get("images") is not None:
-                images_urls = extracted_data.get("images").split('|')
+        async def lookup_images(item):
+            with self.metrics.timer("parse"):
+                extracted_data = self.parse_item(category, item)
 
-                local_img = list()
+            fingerprint = FingerprintCache.fingerprint(item)
+            images = images_cache.get(item.get("Id"), fingerprint)
+            if images is None:
+                with self.metrics.timer("fetch"):
+                    images = await self.get_images(item.get("Id"))
+                if images is not None:
+                    images_cache.put(item.get("Id"), fingerprint, images)
 
-                for img_url in images_urls:
-                    local_img_file_path = os.path.join(
-                        auction_output_dir,
-                        "{img_id}.jpg".format(img_id=self.get_image_id(img_url)))
+            if images is not None:
+                extracted_data["images"] = '|'.join(images)
+            await write_queue.put(extracted_data)
 
-                    if not Util.check_file_exist(local_img_file_path):
-                        local_img.append((img_url, local_img_file_path))
+        async def write_row(extracted_data):
+            with self.metrics.timer("write"):
+                if storage.check_row_exist(extracted_data):
+                    extracted_data["flag"] = self.flags.get("updated")
+                else:
+                    extracted_data["flag"] = self.flags.get("new")
 
-                download_tasks = (self.download_file(img_url, img_file_path)
-                                  for img_url, img_file_path in local_img)
+                storage.update_row(extracted_data)
+                incremental_state.row_written(extracted_data.get("id"))
+                history.append(extracted_data)
 
-                for r in AsyncCrawler.limited_as_completed(download_tasks):
-                    await r
+            auction_output_dir = os.path.join(output_dir, extracted_data.get("id"))
+            image_manifest.create_directory(auction_output_dir)
 
-        csv_manager.close_file()
+            if extracted_data.get("images"):
+                for img_url in extracted_data.get("images").split('|'):
+                    local_img_file_path = os.path.join(
+                        auction_output_dir,
+                        "{img_id}.jpg".format(img_id=self.get_image_id(img_url)))
 
-    async def parse_item(self, category, item):
+                    if not image_manifest.check_file_exist(local_img_file_path):
+                        checkpoint.image_queued(img_url, local_img_file_path)
+                        await download_queue.put((img_url, local_img_file_path))
+
+            # after its images are recorded, so none is lost when the run stops here
+            checkpoint.auction_done(extracted_data.get("id"))
+
+        async def download_image(download):
+            img_url, img_file_path = download
+            with self.metrics.timer("download"):
+                if await self.download_file(img_url, img_file_path):
+                    checkpoint.image_done(img_file_path)
+
+        lookup_workers = AsyncCrawler.start_workers(
+            item_queue, lookup_images, self.pipeline_workers.get("images"))
+        write_workers = AsyncCrawler.start_workers(
+            write_queue, write_row, self.pipeline_workers.get("write"))
+        download_workers = AsyncCrawler.start_workers(
+            download_queue, download_image, self.pipeline_workers.get("download"))
+
+        completed = False
+        try:
+            # images the interrupted run did not download
+            for img_file_path, img_url in checkpoint.pending_images.items():
+                if not image_manifest.check_file_exist(img_file_path):
+                    image_manifest.create_directory(os.path.dirname(img_file_path))
+                    await download_queue.put((img_url, img_file_path))
+
+            async for items in self.search_items(category):
+                for item in items:
+                    # concurrent windows of a changing search result can return an offer twice
+                    if item.get("Id") in seen_offers:
+                        continue
+                    seen_offers.add(item.get("Id"))
+                    if checkpoint.is_auction_done(item.get("Id")):
+                        images_cache.keep(item.get("Id"))
+                        continue
+                    signature = [item.get("Amount"), item.get("AmountBuyNow"), item.get("To")]
+                    if incremental_state.need_fetch(item.get("Id"), signature):
+                        await item_queue.put(item)
+                    else:
+                        images_cache.keep(item.get("Id"))
+                        checkpoint.auction_done(item.get("Id"))
+
+            log.debug("Found: %d auctions of category: %s" % (len(seen_offers), category))
+            completed = True
+        finally:
+            # the queued work is finished and the outputs closed when the listing fails too
+            await AsyncCrawler.stop_workers(item_queue, lookup_workers)
+            await AsyncCrawler.stop_workers(write_queue, write_workers)
+            await AsyncCrawler.stop_workers(download_queue, download_workers)
+
+            if not completed:
+                checkpoint.interrupt()
+            storage.close_file()
+            incremental_state.close()
+            history.close()
+            image_manifest.close()
+            if completed:
+                checkpoint.close()
+
+        images_cache.save()
+        log.debug("Get-images lookups of category: %s cached: %d, requested: %d" %
+                  (category, images_cache.hits, images_cache.misses))
+
+    def parse_item(self, category, item):
         extracted_data = dict()
 
         extracted_data["id"] = item.get("Id")
@@ -184,25 +360,8 @@ class MleasingCrawler(AsyncCrawler):
         extracted_data["type"] = item.get("AuctionType")
 
         if extracted_data.get("type") == self.types.get("auction"):
-            start_time_utc = item.get("From")
-            extracted_data["start"] = None
-            # replace +02:00 utc offset to +0200
-            start_time_utc = start_time_utc[::-1].replace(':', '', 1)[::-1]
-            if '.' in start_time_utc:
-                start_datetime = datetime.strptime(start_time_utc, "%Y-%m-%dT%H:%M:%S.%f%z")
-            else:
-                start_datetime = datetime.strptime(start_time_utc, "%Y-%m-%dT%H:%M:%S%z")
-            extracted_data["start"] = start_datetime.astimezone(timezone("Poland"))
-
-            stop_time_utc = item.get("To")
-            extracted_data["stop"] = None
-            # replace +02:00 utc offset to +0200
-            stop_time_utc = stop_time_utc[::-1].replace(':', '', 1)[::-1]
-            if '.' in stop_time_utc:
-                start_datetime = datetime.strptime(stop_time_utc, "%Y-%m-%dT%H:%M:%S.%f%z")
-            else:
-                stop_time_utc = datetime.strptime(stop_time_utc, "%Y-%m-%dT%H:%M:%S%z")
-            extracted_data["stop"] = stop_time_utc.astimezone(timezone("Poland"))
+            extracted_data["start"] = self.parse_datetime(item.get("From"))
+            extracted_data["stop"] = self.parse_datetime(item.get("To"))
 
             extracted_data["price_pln"] = item.get("Amount")
             extracted_data["price_buy_now_pln"] = item.get("AmountBuyNow")
@@ -222,15 +381,31 @@ class MleasingCrawler(AsyncCrawler):
 
         extracted_data["parameters"] = '|'.join([str(k) + ":" + str(v) for k, v in parameters_dict.items()])
 
+        return extracted_data
+
+    @staticmethod
+    def parse_datetime(time_utc):
+        if time_utc is None:
+            return None
+        # replace +02:00 utc offset to +0200
+        time_utc = time_utc[::-1].replace(':', '', 1)[::-1]
+        if '.' in time_utc:
+            time_datetime = datetime.strptime(time_utc, "%Y-%m-%dT%H:%M:%S.%f%z")
+        else:
+            time_datetime = datetime.strptime(time_utc, "%Y-%m-%dT%H:%M:%S%z")
+        return time_datetime.astimezone(timezone("Poland"))
+
+    async def get_images(self, offer_id):
+        _, page_content = await self.extract_async(self.get_images_api_url_format.format(auction_id=offer_id))
+        if page_content is None:
+            log.error("Get images failed for offer: %s" % offer_id)
+            return None
+
         images = list()
-        _, page_content = await self.extract_async(self.get_images_api_url_format.format(auction_id=item.get("Id")))
-        img_json_obj = json.loads(page_content.decode("utf-8"), encoding="utf-8")
+        img_json_obj = json.loads(page_content.decode("utf-8"))
         for img_json in img_json_obj:
             images.append(self.get_image_api_url_format.format(img_id=img_json.get("Id")))
-
-        extracted_data["images"] = '|'.join(images)
-
-        return extracted_data
+        return images
 
     @staticmethod
     def get_image_id(image_url):
@@ -239,14 +414,27 @@ class MleasingCrawler(AsyncCrawler):
             return int(search.group(1))
 
 
-async def main():
-    async with MleasingCrawler() as mleasing_crawler:
+async def main(incremental=False, storage="csv", metrics_file=None, prometheus_file=None, resume=False):
+    async with MleasingCrawler(incremental=incremental, storage=storage, metrics_file=metrics_file,
+                               prometheus_file=prometheus_file, resume=resume) as mleasing_crawler:
         await mleasing_crawler.start()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true",
+                        help="skip offers whose price and end time did not change")
+    parser.add_argument("--storage", choices=sorted(Storage.backends.keys()), default="csv",
+                        help="where the auctions are stored")
+    parser.add_argument("--metrics-file", help="write the json crawl metrics summary to this file")
+    parser.add_argument("--prometheus-file", help="write the crawl metrics in prometheus text format to this file")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the interrupted run from its checkpoint")
+    args = parser.parse_args()
+
     t0 = time.time()
     log.debug("Crawler started...")
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    loop.run_until_complete(main(args.incremental, args.storage, args.metrics_file, args.prometheus_file,
+                                 args.resume))
     log.debug("Took: %.2f seconds" % (time.time() - t0))
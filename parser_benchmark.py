@@ -0,0 +1,102 @@
+#!/bin/python3.7
+from ideagetin_crawler import IdeagetinCrawler
+from pkoleasing_crawler import PkoleasingCrawler
+from html_parser import HtmlParser
+import asyncio
+import time
+import sys
+import os
+
+
+# fixture file name prefix => (crawler class, function parsing the page content)
+parsers = {
+    "ideagetin_listing": (IdeagetinCrawler, lambda c, content: c.parse_search_result_page(content)),
+    "ideagetin_images": (IdeagetinCrawler, lambda c, content: c.parse_full_images_page(content)),
+    "ideagetin_auction": (IdeagetinCrawler, lambda c, content: c.parse_data(
+        "przyczepy-naczepy", "https://aukcje.ideagetin.pl/aukcja/1/fixture/", content)),
+    "pkoleasing_listing": (PkoleasingCrawler, lambda c, content: c.parse_search_result_page(content)),
+    "pkoleasing_auction": (PkoleasingCrawler, lambda c, content: c.parse_data(
+        "vehicles", "https://aukcje.pkoleasing.pl/en/auction/1", content))
+}
+
+# (parser backend, use strainers)
+configurations = [
+    ("html.parser", False),
+    ("html.parser", True),
+    ("lxml", False),
+    ("lxml", True)
+]
+
+
+async def save_fixtures(fixtures_dir):
+    # one page of every kind from the live sites, the pkoleasing auction is rendered in the browser
+    os.makedirs(fixtures_dir, exist_ok=True)
+
+    def save(name, content):
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        with open(os.path.join(fixtures_dir, name + ".html"), "wb") as fixture_file:
+            fixture_file.write(content)
+
+    async with IdeagetinCrawler(http_cache=False) as crawler:
+        _, listing = await crawler.extract_async(
+            crawler.search_link_format.format(category="przyczepy-naczepy", page_number=1))
+        save("ideagetin_listing", listing)
+        auction_url, _ = crawler.parse_search_result_page(listing)[0]
+        _, auction = await crawler.extract_async(auction_url)
+        save("ideagetin_auction", auction)
+        _, images = await crawler.extract_async(auction_url.replace("aukcja", "zdjecia"))
+        save("ideagetin_images", images)
+
+    async with PkoleasingCrawler(http_cache=False) as crawler:
+        _, listing = await crawler.extract_async(
+            crawler.search_category_url_format.format(category="vehicles", page_number=1))
+        save("pkoleasing_listing", listing)
+        auction_url, _ = crawler.parse_search_result_page(listing)[0]
+        save("pkoleasing_auction", await crawler.browser_pool.get_page_source(auction_url))
+
+
+def run(fixtures_dir, repeat):
+    crawlers = dict()
+    print("%-24s %-12s %9s %12s" % ("fixture", "parser", "strainers", "ms / page"))
+    for file_name in sorted(os.listdir(fixtures_dir)):
+        prefix = file_name.split('.')[0].rstrip("0123456789_")
+        if prefix not in parsers:
+            continue
+
+        crawler_class, parse = parsers.get(prefix)
+        if crawler_class not in crawlers:
+            crawlers[crawler_class] = crawler_class(http_cache=False)
+        crawler = crawlers.get(crawler_class)
+
+        with open(os.path.join(fixtures_dir, file_name), "rb") as fixture_file:
+            content = fixture_file.read()
+
+        expected = None
+        for parser, use_strainers in configurations:
+            HtmlParser.parser = parser
+            HtmlParser.use_strainers = use_strainers
+
+            t0 = time.perf_counter()
+            for _ in range(repeat):
+                result = parse(crawler, content)
+            took = (time.perf_counter() - t0) / repeat
+
+            # compared by repr, nan prices never compare equal
+            if expected is None:
+                expected = repr(result)
+            elif repr(result) != expected:
+                print("%s: %s strainers=%s gives a different result" % (file_name, parser, use_strainers))
+
+            print("%-24s %-12s %9s %12.2f" % (file_name, parser, use_strainers, took * 1000))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ("save", "run"):
+        print("Usage: %s save|run <fixtures dir> [repeat]" % sys.argv[0])
+        sys.exit(1)
+
+    if sys.argv[1] == "save":
+        asyncio.get_event_loop().run_until_complete(save_fixtures(sys.argv[2]))
+    else:
+        run(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 20)
@@ -1,14 +1,20 @@
 #!/bin/python3.7
 from async_crawler import AsyncCrawler
-from csv_manager import CsvManager
+from storage import Storage
+from snapshot_history import SnapshotHistory
+from incremental_state import IncrementalState
+from image_manifest import ImageManifest
+from crawl_checkpoint import CrawlCheckpoint
 from util import Util
-from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
+from browser_pool import BrowserPool
+from selenium.common.exceptions import WebDriverException
+from html_parser import HtmlParser
 import logutil
 import logging
+import argparse
 import asyncio
 import time
+import math
 import sys
 import re
 import os
@@ -57,11 +63,30 @@ _translate = {
 log = logging.getLogger("pkoleasing_crawler")
 logutil.init_log(log, logging.DEBUG)
 
+# parse only the parts of the pages the crawler reads
+_pagination_strainer = HtmlParser.class_strainer("ul", "pagination")
+_listing_strainer = HtmlParser.class_strainer("div", "list-item")
+_auction_strainer = HtmlParser.class_strainer("div", "auction")
+
 
 class PkoleasingCrawler(AsyncCrawler):
 
-    def __init__(self, max_concurrency=200):
-        AsyncCrawler.__init__(self, max_concurrency)
+    unpicklable_attributes = AsyncCrawler.unpicklable_attributes + ("browser_pool",)
+
+    def __init__(self, max_concurrency=200, http_cache=True, num_browsers=4, browser_recycle_after=100,
+                 render_free=True, parse_workers=None, incremental=False,
+                 storage="csv", blob_store=True, metrics_file=None, prometheus_file=None,
+                 semaphore=None, resume=False):
+        cache_dir = None
+        if http_cache:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Pkoleasing", ".http_cache")
+        # images are deduplicated in a store shared by all crawlers and categories
+        blob_store_dir = None
+        if blob_store:
+            blob_store_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".blobs")
+        AsyncCrawler.__init__(self, max_concurrency, cache_dir=cache_dir, parse_workers=parse_workers,
+                              blob_store_dir=blob_store_dir, metrics_file=metrics_file,
+                              prometheus_file=prometheus_file, semaphore=semaphore)
 
         self.site_url = "https://aukcje.pkoleasing.pl/en/"
         self.search_category_url_format = \
@@ -73,12 +98,32 @@ class PkoleasingCrawler(AsyncCrawler):
 
         log.debug("Output directory path format: %s" % self.output_dir_path_format)
 
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--disable-dev-shm-usage")
+        self.browser_pool = BrowserPool(num_browsers, browser_recycle_after)
+
+        # try the raw html first and render in the browser only when the angular bound fields are missing
+        self.render_free = render_free
+        self.render_stats = {
+            "raw": 0,
+            "browser": 0
+        }
+        # number of concurrent workers of each crawl_pages pipeline stage,
+        # auction renders beyond num_browsers wait in the browser pool
+        self.pipeline_workers = {
+            "auction": 20,
+            # csv writes are not concurrent safe, keep a single writer
+            "write": 1,
+            "download": 40
+        }
+        self.pipeline_queue_size = 100
 
-        self.driver = webdriver.Chrome(executable_path="/bin/chromedriver", options=chrome_options)
+        # skip the auction pages whose listing entry did not change
+        self.incremental = incremental
+
+        # "csv" or "sqlite", see Storage.backends
+        self.storage = storage
+
+        # continue from the checkpoint of an interrupted run
+        self.resume = resume
 
         # category name => catid
         self.categories = {
@@ -124,6 +169,12 @@ class PkoleasingCrawler(AsyncCrawler):
 
         self.field_names = [field_name for field_name, _ in self.fields]
 
+    async def __aexit__(self, *err):
+        log.debug("Auction pages parsed from raw html: %d, rendered in browser: %d" %
+                  (self.render_stats.get("raw"), self.render_stats.get("browser")))
+        self.browser_pool.close()
+        await AsyncCrawler.__aexit__(self, *err)
+
     async def start(self):
         first_pages = [
             self.search_category_url_format.format(category=category, page_number=1)
@@ -137,7 +188,7 @@ class PkoleasingCrawler(AsyncCrawler):
             url, page_content = await page
             # Get max pages for this category
             max_page = 1
-            soup = BeautifulSoup(page_content, 'html.parser')
+            soup = HtmlParser.parse(page_content, _pagination_strainer)
             pagination = soup.find("ul", {"class": "pagination"})
             if pagination is not None:
                 for page_num in pagination.findAll("a"):
@@ -159,67 +210,172 @@ class PkoleasingCrawler(AsyncCrawler):
             await page
 
     async def crawl_pages(self, category, max_pages):
-        pages = (self.search_category_url_format.format(category=category, page_number=page_number)
-                 for page_number in range(1, max_pages + 1))
-
-        auctions_links = list()
-
-        tasks = (self.extract_async(url) for url in pages)
-        for page in AsyncCrawler.limited_as_completed(tasks, 5):
-            url, page_content = await page
-            if url is not None and page_content is not None:
-                auctions_links.extend(self.parse_search_result_page(page_content))
-
-        if not auctions_links:
-            log.warning("No results found for category: %s" % category)
-            return
-
-        log.debug("Found: %d auctions in %d pages of category: %s" % (len(auctions_links), max_pages, category))
-
         output_dir = self.output_dir_path_format.format(category=category)
-        csv_file_path = os.path.join(output_dir, "{category}.csv".format(category=category))
 
         Util.create_directory(output_dir)
 
-        csv_manager = CsvManager(csv_file_path, self.fields, "id")
-        csv_manager.open_file()
+        storage = Storage.create(self.storage, output_dir, category, self.fields, "id")
 
-        for auction_url in auctions_links:
-            self.driver.get(auction_url)
+        # written listing pages, auctions and pending images, so an interrupted run can be resumed
+        checkpoint = CrawlCheckpoint(os.path.join(output_dir, ".checkpoint.jsonl"), storage, self.resume)
+        checkpoint.open()
 
-            extracted_data = self.parse_data(category, auction_url, self.driver.page_source)
-            if csv_manager.check_row_exist(extracted_data):
-                log.debug("row already existed in csv")
-                extracted_data["flag"] = self.flags.get("updated")
-            else:
-                log.debug("row in new")
-                extracted_data["flag"] = self.flags.get("new")
+        storage.open_file(self.resume, checkpoint.auctions_done)
 
-            csv_manager.update_row(extracted_data)
+        pages = (self.search_category_url_format.format(category=category, page_number=page_number)
+                 for page_number in range(1, max_pages + 1))
+        pages = (url for url in pages if not checkpoint.is_page_done(url))
+
+        incremental_state = IncrementalState(os.path.join(output_dir, ".listing_cache.json"),
+                                             storage, self.incremental)
+        incremental_state.open()
+
+        # price fields of every written row are appended to the price history of the category
+        history = SnapshotHistory(os.path.join(output_dir, ".history"),
+                                  [field_name for field_name, field_type in self.fields if field_type is float])
+
+        # downloaded images are listed once up front instead of a stat call per image
+        image_manifest = ImageManifest(output_dir)
+        image_manifest.load()
+
+        # listing -> auction page (raw html or rendered) -> csv write -> image download,
+        # every stage has its own bounded queue and worker pool, auctions are fetched while
+        # the next listing pages are still loading
+        auction_queue = asyncio.Queue(maxsize=self.pipeline_queue_size)
+        write_queue = asyncio.Queue(maxsize=self.pipeline_queue_size)
+        download_queue = asyncio.Queue(maxsize=self.pipeline_queue_size)
+
+        async def fetch_auction(auction_url):
+            try:
+                extracted_data = await self.get_auction_data(category, auction_url)
+            except WebDriverException as e:
+                log.error("Failed to render auction page: %s" % e)
+                return
+            if extracted_data is not None:
+                await write_queue.put(extracted_data)
+
+        async def write_row(extracted_data):
+            with self.metrics.timer("write"):
+                if storage.check_row_exist(extracted_data):
+                    log.debug("row already existed in csv")
+                    extracted_data["flag"] = self.flags.get("updated")
+                else:
+                    log.debug("row in new")
+                    extracted_data["flag"] = self.flags.get("new")
+
+                storage.update_row(extracted_data)
+                incremental_state.row_written(extracted_data.get("id"))
+                history.append(extracted_data)
 
             auction_output_dir = os.path.join(output_dir, extracted_data.get("id"))
-            Util.create_directory(auction_output_dir)
+            image_manifest.create_directory(auction_output_dir)
 
             if extracted_data.get("images") is not None:
                 images_urls = extracted_data.get("images").split('|')
 
-                local_img = list()
-
                 for img_url in images_urls:
                     local_img_file_path = os.path.join(
                         auction_output_dir,
                         "{img_id}.png".format(img_id=self.get_image_id(img_url)))
 
-                    if not Util.check_file_exist(local_img_file_path):
-                        local_img.append((img_url, local_img_file_path))
-
-                download_tasks = (self.download_file(img_url, img_file_path)
-                                  for img_url, img_file_path in local_img)
+                    if not image_manifest.check_file_exist(local_img_file_path):
+                        checkpoint.image_queued(img_url, local_img_file_path)
+                        await download_queue.put((img_url, local_img_file_path))
+
+            # after its images are recorded, so none is lost when the run stops here
+            checkpoint.auction_done(extracted_data.get("id"))
+
+        async def download_image(download):
+            img_url, img_file_path = download
+            with self.metrics.timer("download"):
+                if await self.download_file(img_url, img_file_path):
+                    checkpoint.image_done(img_file_path)
+
+        auction_workers = AsyncCrawler.start_workers(
+            auction_queue, fetch_auction, self.pipeline_workers.get("auction"))
+        write_workers = AsyncCrawler.start_workers(
+            write_queue, write_row, self.pipeline_workers.get("write"))
+        download_workers = AsyncCrawler.start_workers(
+            download_queue, download_image, self.pipeline_workers.get("download"))
+
+        completed = False
+        try:
+            # images the interrupted run did not download
+            for img_file_path, img_url in checkpoint.pending_images.items():
+                if not image_manifest.check_file_exist(img_file_path):
+                    image_manifest.create_directory(os.path.dirname(img_file_path))
+                    await download_queue.put((img_url, img_file_path))
+
+            num_auctions = 0
+            tasks = (self.extract_async(url) for url in pages)
+            for page in AsyncCrawler.limited_as_completed(tasks, 5):
+                url, page_content = await page
+                if url is not None and page_content is not None:
+                    with self.metrics.timer("parse_listing"):
+                        auctions_links = await self.run_parser(self.parse_search_result_page, page_content)
+                    checkpoint.page_listed(url, [self.get_auction_id(auction_url) for auction_url, _ in auctions_links])
+                    for auction_url, signature in auctions_links:
+                        num_auctions += 1
+                        auction_id = self.get_auction_id(auction_url)
+                        if checkpoint.is_auction_done(auction_id):
+                            continue
+                        # blocks while the auction workers are behind, the listing is not read ahead
+                        if incremental_state.need_fetch(auction_id, signature):
+                            await auction_queue.put(auction_url)
+                        else:
+                            checkpoint.auction_done(auction_id)
+
+            if not num_auctions:
+                log.warning("No results found for category: %s" % category)
+            else:
+                log.debug("Found: %d auctions in %d pages of category: %s" % (num_auctions, max_pages, category))
+            completed = True
+        finally:
+            # the queued work is finished and the outputs closed when the listing fails too
+            await AsyncCrawler.stop_workers(auction_queue, auction_workers)
+            await AsyncCrawler.stop_workers(write_queue, write_workers)
+            await AsyncCrawler.stop_workers(download_queue, download_workers)
+
+            if not completed:
+                checkpoint.interrupt()
+            storage.close_file()
+            incremental_state.close()
+            history.close()
+            image_manifest.close()
+            if completed:
+                checkpoint.close()
+
+    async def get_auction_data(self, category, auction_url):
+        if self.render_free:
+            with self.metrics.timer("fetch"):
+                _, page_content = await self.extract_async(auction_url)
+            if page_content is not None:
+                with self.metrics.timer("parse"):
+                    extracted_data = await self.run_parser(self.parse_data, category, auction_url, page_content)
+                if self.has_required_fields(extracted_data):
+                    self.render_stats["raw"] += 1
+                    return extracted_data
+
+        self.render_stats["browser"] += 1
+        with self.metrics.timer("render"):
+            page_source = await self.browser_pool.get_page_source(auction_url)
+        with self.metrics.timer("parse"):
+            return await self.run_parser(self.parse_data, category, auction_url, page_source)
 
-                for r in AsyncCrawler.limited_as_completed(download_tasks):
-                    await r
+    @staticmethod
+    def has_required_fields(extracted_data):
+        # values bound by angular (ng-bind) are empty in the raw html until rendered
+        if extracted_data is None or not extracted_data.get("stop"):
+            return False
+        for field in ("price_pln", "price_pln_brutto", "price_euro"):
+            value = extracted_data.get(field)
+            if value is None or math.isnan(value):
+                return False
+        return True
 
-        csv_manager.close_file()
+    @staticmethod
+    def get_auction_id(auction_url):
+        return auction_url.split('/')[-1]
 
     @staticmethod
     def get_image_id(img_url):
@@ -230,7 +386,7 @@ class PkoleasingCrawler(AsyncCrawler):
     @staticmethod
     def parse_search_result_page(page_content):
         auctions_links = list()
-        soup = BeautifulSoup(page_content, 'html.parser')
+        soup = HtmlParser.parse(page_content, _listing_strainer)
 
         results = soup.findAll("div", {"class": "list-item"})
         if not results:
@@ -239,12 +395,23 @@ class PkoleasingCrawler(AsyncCrawler):
             for r in results:
                 anchor_url = r.find("a")
                 if anchor_url is not None:
-                    auctions_links.append(anchor_url.get("href"))
+                    auctions_links.append((anchor_url.get("href"), PkoleasingCrawler.parse_listing_signature(r)))
 
         return auctions_links
 
+    @staticmethod
+    def parse_listing_signature(list_item):
+        # current price and end date of the listing entry, the rest of its text (views, countdown)
+        # changes without the auction changing; without both the auction is always fetched
+        price = list_item.find(class_=re.compile("price"))
+        end_date = re.search("[0-9]{2}[.-][0-9]{2}[.-][0-9]{4}( [0-9]{2}:[0-9]{2})?|"
+                             "[0-9]{4}-[0-9]{2}-[0-9]{2}( [0-9]{2}:[0-9]{2})?", list_item.text)
+        if price is None or end_date is None:
+            return list()
+        return [' '.join(price.text.split()), end_date.group(0)]
+
     def parse_pdf_url(self, page_content):
-        soup = BeautifulSoup(page_content, 'html.parser')
+        soup = HtmlParser.parse(page_content, _auction_strainer)
         auction_soup = soup.find("div", {"class": "auction"})
 
         if auction_soup is None:
@@ -258,7 +425,7 @@ class PkoleasingCrawler(AsyncCrawler):
         return None
 
     def parse_data(self, category, page_url, page_content):
-        soup = BeautifulSoup(page_content, 'html.parser')
+        soup = HtmlParser.parse(page_content, _auction_strainer)
 
         auction_soup = soup.find("div", {"class": "auction"})
 
@@ -269,7 +436,7 @@ class PkoleasingCrawler(AsyncCrawler):
         extracted_data = dict()
         extracted_data["link"] = page_url
 
-        auction_id = page_url.split('/')[-1]
+        auction_id = self.get_auction_id(page_url)
         extracted_data["id"] = auction_id
         extracted_data["link"] = page_url
         extracted_data["category_id"] = self.categories.get(category)
@@ -374,14 +541,27 @@ class PkoleasingCrawler(AsyncCrawler):
         return extracted_data
 
 
-async def main():
-    async with PkoleasingCrawler() as pkoleasing_crawler:
+async def main(incremental=False, storage="csv", metrics_file=None, prometheus_file=None, resume=False):
+    async with PkoleasingCrawler(incremental=incremental, storage=storage, metrics_file=metrics_file,
+                                 prometheus_file=prometheus_file, resume=resume) as pkoleasing_crawler:
         await pkoleasing_crawler.start()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true",
+                        help="skip auctions whose listing entry did not change")
+    parser.add_argument("--storage", choices=sorted(Storage.backends.keys()), default="csv",
+                        help="where the auctions are stored")
+    parser.add_argument("--metrics-file", help="write the json crawl metrics summary to this file")
+    parser.add_argument("--prometheus-file", help="write the crawl metrics in prometheus text format to this file")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the interrupted run from its checkpoint")
+    args = parser.parse_args()
+
     t0 = time.time()
     log.debug("Crawler started...")
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    loop.run_until_complete(main(args.incremental, args.storage, args.metrics_file, args.prometheus_file,
+                                 args.resume))
     log.debug("Took: %.2f seconds" % (time.time() - t0))
@@ -0,0 +1,302 @@
+#!/bin/python3.7
+from ideagetin_crawler import IdeagetinCrawler
+from mleasing_crawler import MleasingCrawler
+from pkoleasing_crawler import PkoleasingCrawler
+from selenium.common.exceptions import WebDriverException
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, unquote
+from multiprocessing import Process
+from aiohttp import web
+import tempfile
+import resource
+import argparse
+import asyncio
+import hashlib
+import random
+import socket
+import shutil
+import json
+import time
+import os
+
+
+# site name => crawler class
+crawlers = {
+    "ideagetin": IdeagetinCrawler,
+    "mleasing": MleasingCrawler,
+    "pkoleasing": PkoleasingCrawler
+}
+
+# pages rendered by the browser are recorded and served under this path prefix
+rendered_prefix = "/__rendered__"
+
+
+def get_origin(url):
+    parts = urlsplit(url)
+    return "{scheme}://{netloc}".format(scheme=parts.scheme, netloc=parts.netloc)
+
+
+def get_fixture_key(path_qs):
+    # urls are requoted by the client, compare them unquoted
+    return unquote(path_qs)
+
+
+def get_url_key(url):
+    parts = urlsplit(url)
+    path_qs = parts.path if not parts.query else parts.path + "?" + parts.query
+    return get_fixture_key(path_qs)
+
+
+# Fixtures of one site: <fixtures dir>/<site>/index.json with the live origin, the crawled
+# categories and the responses by path, the bodies are stored next to it named by url hash.
+class Fixtures:
+
+    def __init__(self, fixtures_dir, site):
+        self.site_dir = os.path.join(fixtures_dir, site)
+        self.index_file_path = os.path.join(self.site_dir, "index.json")
+        self.origin = None
+        self.categories = dict()
+        # path => {"file", "content_type"}
+        self.responses = dict()
+
+    def load(self):
+        with open(self.index_file_path, "r", encoding="utf-8") as index_file:
+            index = json.load(index_file)
+        self.origin = index.get("origin")
+        self.categories = index.get("categories")
+        self.responses = index.get("responses")
+
+    def save(self):
+        with open(self.index_file_path, "w", encoding="utf-8") as index_file:
+            json.dump({"origin": self.origin, "categories": self.categories, "responses": self.responses},
+                      index_file, indent=1)
+
+    def put(self, key, content, content_type):
+        os.makedirs(self.site_dir, exist_ok=True)
+        file_name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        with open(os.path.join(self.site_dir, file_name), "wb") as body_file:
+            body_file.write(content)
+        self.responses[key] = {"file": file_name, "content_type": content_type}
+
+    def get(self, key):
+        response = self.responses.get(key)
+        if response is None:
+            return None, None
+        with open(os.path.join(self.site_dir, response.get("file")), "rb") as body_file:
+            return body_file.read(), response.get("content_type")
+
+
+# Serves the recorded responses of one site, the live origin in html/json bodies is replaced by
+# the local one so absolute links stay on the server.
+def serve(fixtures_dir, site, port, latency, jitter, error_rate):
+    fixtures = Fixtures(fixtures_dir, site)
+    fixtures.load()
+    local_origin = ("http://127.0.0.1:%d" % port).encode("utf-8")
+    live_origin = fixtures.origin.encode("utf-8")
+
+    async def handle(request):
+        await asyncio.sleep(max(0.0, random.uniform(latency - jitter, latency + jitter)))
+        if random.random() < error_rate:
+            return web.Response(status=503)
+
+        content, content_type = fixtures.get(get_fixture_key(request.raw_path))
+        if content is None:
+            return web.Response(status=404)
+        if content_type.startswith("text/") or "json" in content_type:
+            content = content.replace(live_origin, local_origin)
+        return web.Response(body=content, headers={"Content-Type": content_type})
+
+    app = web.Application()
+    app.router.add_route("GET", "/{tail:.*}", handle)
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Replay server did not start on port: %d" % port)
+
+
+# Stands in for the selenium browser pool of PkoleasingCrawler: the page source recorded from
+# the browser is fetched from the replay server.
+class ReplayBrowserPool:
+
+    def __init__(self, crawler, local_origin):
+        self.crawler = crawler
+        self.local_origin = local_origin
+        self.pages_rendered = 0
+
+    async def get_page_source(self, url):
+        parts = urlsplit(url)
+        path_qs = parts.path if not parts.query else parts.path + "?" + parts.query
+        _, page_content = await self.crawler.extract_async(self.local_origin + rendered_prefix + path_qs)
+        if page_content is None:
+            raise WebDriverException("No recorded render of: %s" % url)
+        self.pages_rendered += 1
+        return page_content.decode("utf-8")
+
+    def close(self):
+        pass
+
+
+def point_to(crawler, live_origin, local_origin, output_dir):
+    # every url format of the crawler is an attribute starting with the live origin
+    for attribute, value in list(vars(crawler).items()):
+        if isinstance(value, str) and value.startswith(live_origin):
+            setattr(crawler, attribute, local_origin + value[len(live_origin):])
+    crawler.output_dir_path_format = os.path.join(output_dir, "{category}")
+
+
+async def record_site(site, fixtures_dir, num_categories):
+    crawler = crawlers.get(site)(http_cache=False, blob_store=False)
+    fixtures = Fixtures(fixtures_dir, site)
+    fixtures.origin = get_origin(crawler.site_url)
+    fixtures.categories = dict(list(crawler.categories.items())[:num_categories])
+    crawler.categories = fixtures.categories
+
+    http_request = crawler._http_request
+    download_file = crawler.download_file
+
+    async def recording_http_request(url, session=None):
+        content = await http_request(url, session)
+        if content is not None:
+            content_type = "application/json" if content[:1] in (b"{", b"[") else "text/html; charset=utf-8"
+            fixtures.put(get_url_key(url), content, content_type)
+        return content
+
+    async def recording_download_file(url, local_file_path):
+        downloaded = await download_file(url, local_file_path)
+        if downloaded:
+            with open(local_file_path, "rb") as image_file:
+                fixtures.put(get_url_key(url), image_file.read(), "image/jpeg")
+        return downloaded
+
+    crawler._http_request = recording_http_request
+    crawler.download_file = recording_download_file
+
+    if isinstance(crawler, PkoleasingCrawler):
+        get_page_source = crawler.browser_pool.get_page_source
+
+        async def recording_get_page_source(url):
+            page_source = await get_page_source(url)
+            fixtures.put(rendered_prefix + get_url_key(url), page_source.encode("utf-8"),
+                         "text/html; charset=utf-8")
+            return page_source
+
+        crawler.browser_pool.get_page_source = recording_get_page_source
+
+    output_dir = tempfile.mkdtemp()
+    try:
+        crawler.output_dir_path_format = os.path.join(output_dir, "{category}")
+        async with crawler:
+            await crawler.start()
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    fixtures.save()
+    print("Recorded %d responses of %s" % (len(fixtures.responses), site))
+
+
+async def replay_site(site, fixtures_dir, port, output_dir):
+    fixtures = Fixtures(fixtures_dir, site)
+    fixtures.load()
+    local_origin = "http://127.0.0.1:%d" % port
+
+    crawler = crawlers.get(site)(http_cache=False, blob_store=False)
+    crawler.categories = fixtures.categories
+    point_to(crawler, get_origin(crawler.site_url), local_origin, output_dir)
+    if isinstance(crawler, PkoleasingCrawler):
+        crawler.browser_pool = ReplayBrowserPool(crawler, local_origin)
+
+    async with crawler:
+        await crawler.start()
+    return crawler.metrics.summary()
+
+
+def run_site(site, fixtures_dir, port):
+    # runs in a process of its own, so cpu time and peak rss belong to this crawler only
+    output_dir = tempfile.mkdtemp()
+    start_time = time.time()
+    try:
+        metrics = asyncio.get_event_loop().run_until_complete(replay_site(site, fixtures_dir, port, output_dir))
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    wall_time = time.time() - start_time
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    pools = metrics.get("pools")
+    pages = pools.get("pages", dict()).get("requests", 0)
+    assets = pools.get("assets", dict()).get("requests", 0)
+    return {
+        "site": site,
+        "wall_seconds": round(wall_time, 3),
+        "pages": pages,
+        "assets": assets,
+        "pages_per_second": round(pages / wall_time, 1),
+        "requests_per_second": round((pages + assets) / wall_time, 1),
+        "cpu_seconds": round(usage.ru_utime + usage.ru_stime +
+                             children_usage.ru_utime + children_usage.ru_stime, 3),
+        # kilobytes on linux
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "retries": sum(pool.get("retries") for pool in pools.values()),
+        "stages": {stage_name: round(stage.get("seconds"), 3)
+                   for stage_name, stage in metrics.get("stages").items()}
+    }
+
+
+def run(fixtures_dir, sites, port, latency, jitter, error_rate, repeat, report_file):
+    reports = list()
+    for site in sites:
+        server = Process(target=serve, args=(fixtures_dir, site, port, latency, jitter, error_rate), daemon=True)
+        server.start()
+        try:
+            wait_for_port(port)
+            for _ in range(repeat):
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    report = executor.submit(run_site, site, fixtures_dir, port).result()
+                reports.append(report)
+                print("%-10s %7.2f s %6d pages %6d assets %8.1f pages/s %7.2f cpu s %7.1f MB rss %4d retries" %
+                      (site, report.get("wall_seconds"), report.get("pages"), report.get("assets"),
+                       report.get("pages_per_second"), report.get("cpu_seconds"), report.get("peak_rss_mb"),
+                       report.get("retries")))
+        finally:
+            server.terminate()
+            server.join()
+
+    if report_file is not None:
+        with open(report_file, "w", encoding="utf-8") as f:
+            json.dump({"latency": latency, "jitter": jitter, "error_rate": error_rate, "runs": reports}, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    record_parser = subparsers.add_parser("record", help="record the pages of the live sites as fixtures")
+    record_parser.add_argument("fixtures_dir")
+    record_parser.add_argument("--sites", nargs="+", choices=sorted(crawlers.keys()), default=sorted(crawlers.keys()))
+    record_parser.add_argument("--categories", type=int, default=1, help="number of categories recorded per site")
+
+    run_parser = subparsers.add_parser("run", help="crawl the recorded fixtures from a local server")
+    run_parser.add_argument("fixtures_dir")
+    run_parser.add_argument("--sites", nargs="+", choices=sorted(crawlers.keys()), default=sorted(crawlers.keys()))
+    run_parser.add_argument("--port", type=int, default=8790)
+    run_parser.add_argument("--latency", type=float, default=0.05, help="mean response delay in seconds")
+    run_parser.add_argument("--jitter", type=float, default=0.02, help="response delay spread in seconds")
+    run_parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    run_parser.add_argument("--repeat", type=int, default=1)
+    run_parser.add_argument("--report-file", help="write the results as json to this file")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        for site_name in args.sites:
+            asyncio.get_event_loop().run_until_complete(record_site(site_name, args.fixtures_dir, args.categories))
+    else:
+        run(args.fixtures_dir, args.sites, args.port, args.latency, args.jitter, args.error_rate,
+            args.repeat, args.report_file)
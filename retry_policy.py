@@ -0,0 +1,55 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import random
+
+
+# When and how long to wait before a failed request is sent again: exponential backoff with
+# jitter, so requests failing together are not retried together, or the Retry-After delay the
+# server asked for. Statuses outside retryable_statuses (404, 403, ...) fail at once.
+class RetryPolicy:
+
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=30.0, max_retry_after=120.0,
+                 retryable_statuses=(408, 425, 429, 500, 502, 503, 504),
+                 retry_after_statuses=(429, 503)):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # longest Retry-After honored, a server asking for more is retried after this
+        self.max_retry_after = max_retry_after
+        self.retryable_statuses = frozenset(retryable_statuses)
+        self.retry_after_statuses = frozenset(retry_after_statuses)
+
+    def is_retryable_status(self, status):
+        return status in self.retryable_statuses
+
+    def get_retry_after(self, status, headers):
+        if status not in self.retry_after_statuses or headers is None:
+            return None
+        return RetryPolicy.parse_retry_after(headers.get("Retry-After"))
+
+    def get_delay(self, attempt, retry_after=None):
+        # attempt is the number of failed attempts so far, half the backoff is randomized
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        delay = backoff / 2 + random.uniform(0, backoff / 2)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_retry_after))
+        return delay
+
+    @staticmethod
+    def parse_retry_after(value):
+        # delay in seconds or an http date
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date is None:
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
@@ -0,0 +1,82 @@
+#!/bin/python3.7
+from ideagetin_crawler import IdeagetinCrawler
+from mleasing_crawler import MleasingCrawler
+from pkoleasing_crawler import PkoleasingCrawler
+from storage import Storage
+import logutil
+import logging
+import argparse
+import asyncio
+import time
+
+
+log = logging.getLogger("run_all")
+logutil.init_log(log, logging.DEBUG)
+
+
+# site name => crawler class
+crawlers = {
+    "ideagetin": IdeagetinCrawler,
+    "mleasing": MleasingCrawler,
+    "pkoleasing": PkoleasingCrawler
+}
+
+
+async def crawl_site(site, crawler):
+    # the log lines of the sites running together are interleaved, the site names tell them apart
+    log.debug("Site %s started" % site)
+    t0 = time.time()
+    async with crawler:
+        await crawler.start()
+    log.debug("Site %s finished" % site)
+    return time.time() - t0
+
+
+async def main(sites, max_concurrency=200, incremental=False, storage="csv"):
+    # The sites are crawled at the same time on one event loop, their requests share one concurrency
+    # budget, so a full refresh takes about as long as the slowest site
+    semaphore = asyncio.BoundedSemaphore(max_concurrency)
+    site_crawlers = [(site, crawlers.get(site)(incremental=incremental, storage=storage, semaphore=semaphore))
+                     for site in sites]
+
+    t0 = time.time()
+    results = await asyncio.gather(*[crawl_site(site, crawler) for site, crawler in site_crawlers],
+                                   return_exceptions=True)
+    total_time = time.time() - t0
+
+    # a failing site does not stop the others
+    failed = 0
+    for (site, crawler), result in zip(site_crawlers, results):
+        if isinstance(result, BaseException):
+            failed += 1
+            log.error("Site %s failed: %s" % (site, repr(result)))
+        else:
+            pools = crawler.metrics.summary().get("pools")
+            log.info("Site %s took: %.2f seconds, pages: %d, assets: %d" %
+                     (site, result, pools.get("pages", dict()).get("requests", 0),
+                      pools.get("assets", dict()).get("requests", 0)))
+
+    log.info("All sites took: %.2f seconds (sum of the sites: %.2f seconds), failed: %d" %
+             (total_time, sum(result for result in results if not isinstance(result, BaseException)), failed))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sites", nargs="+", choices=sorted(crawlers.keys()), default=sorted(crawlers.keys()),
+                        help="sites crawled at the same time")
+    parser.add_argument("--max-concurrency", type=int, default=200,
+                        help="requests in flight across all the sites")
+    parser.add_argument("--incremental", action="store_true",
+                        help="skip auctions whose listing entry did not change")
+    parser.add_argument("--storage", choices=sorted(Storage.backends.keys()), default="csv",
+                        help="where the auctions are stored")
+    args = parser.parse_args()
+
+    t0 = time.time()
+    log.debug("Crawlers started...")
+    loop = asyncio.get_event_loop()
+    num_failed = loop.run_until_complete(main(args.sites, args.max_concurrency, args.incremental, args.storage))
+    log.debug("Took: %.2f seconds" % (time.time() - t0))
+    if num_failed:
+        raise SystemExit(1)
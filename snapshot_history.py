@@ -0,0 +1,145 @@
+from datetime import datetime, timezone
+from util import Util
+import logutil
+import logging
+import uuid
+import sys
+import os
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+log = logging.getLogger("snapshot_history")
+logutil.init_log(log, logging.DEBUG)
+
+
+# Every run appends one parquet file of (id, timestamp, prices, stop, flag) rows to the history
+# directory of a category. Rows are sorted by id so the row group statistics let a query for one
+# auction skip most of the data. Once there are more than max_files files they are compacted into one.
+class SnapshotHistory:
+
+    def __init__(self, history_dir, price_fields, row_group_size=64 * 1024, max_files=32):
+        self.history_dir = history_dir
+        self.price_fields = list(price_fields)
+        self.row_group_size = row_group_size
+        self.max_files = max_files
+        self.timestamp = datetime.now(timezone.utc).replace(microsecond=0)
+        # (id, stop, flag, prices...) rows of this run, only the history columns of the auctions are kept
+        self.snapshots = list()
+
+        if pyarrow is None:
+            log.warning("pyarrow is not installed, price history is not recorded")
+
+    def append(self, extracted_data):
+        if pyarrow is None:
+            return
+        stop = extracted_data.get("stop")
+        snapshot = [str(extracted_data.get("id")), str(stop) if stop is not None else None, extracted_data.get("flag")]
+        snapshot.extend(self._float_or_none(extracted_data.get(price_field)) for price_field in self.price_fields)
+        self.snapshots.append(tuple(snapshot))
+
+    def _schema(self):
+        fields = [
+            ("id", pyarrow.string()),
+            ("timestamp", pyarrow.timestamp("s", tz="UTC"))
+        ]
+        fields.extend((price_field, pyarrow.float64()) for price_field in self.price_fields)
+        fields.extend([
+            ("stop", pyarrow.string()),
+            ("flag", pyarrow.int8())
+        ])
+        return pyarrow.schema(fields)
+
+    @staticmethod
+    def _float_or_none(value):
+        try:
+            return float(value) if value is not None and value != "" else None
+        except ValueError:
+            return None
+
+    def close(self):
+        if pyarrow is None or not self.snapshots:
+            return
+
+        snapshots = sorted(self.snapshots, key=lambda snapshot: snapshot[0])
+        columns = {
+            "id": [snapshot[0] for snapshot in snapshots],
+            "timestamp": [self.timestamp] * len(snapshots),
+            "stop": [snapshot[1] for snapshot in snapshots],
+            "flag": [snapshot[2] for snapshot in snapshots]
+        }
+        for i, price_field in enumerate(self.price_fields):
+            columns[price_field] = [snapshot[3 + i] for snapshot in snapshots]
+
+        table = pyarrow.Table.from_pydict(columns, schema=self._schema())
+
+        Util.create_directory(self.history_dir)
+        file_name = self._write_file("snapshot", table)
+
+        log.debug("Appended %d snapshots to %s" % (len(snapshots), file_name))
+        self.snapshots = list()
+
+        if len(SnapshotHistory._history_files(self.history_dir)) > self.max_files:
+            self.compact()
+
+    def _write_file(self, prefix, table):
+        file_name = "{prefix}-{time}-{suffix}.parquet".format(
+            prefix=prefix, time=self.timestamp.strftime("%Y%m%dT%H%M%S"), suffix=uuid.uuid4().hex[:8])
+        # the partial file starts with a dot, so it is never read as part of the history
+        part_file_path = os.path.join(self.history_dir, "." + file_name + ".part")
+        pyarrow.parquet.write_table(table, part_file_path, row_group_size=self.row_group_size,
+                                    compression="zstd")
+        file_path = os.path.join(self.history_dir, file_name)
+        os.replace(part_file_path, file_path)
+        return file_path
+
+    def compact(self):
+        # all the files are merged into one sorted by id, a run killed before the inputs are removed
+        # leaves duplicate snapshots, price_history drops them
+        file_paths = SnapshotHistory._history_files(self.history_dir)
+        table = pyarrow.dataset.dataset(file_paths, schema=self._schema(), format="parquet").to_table()
+        table = table.take(pyarrow.compute.sort_indices(
+            table, sort_keys=[("id", "ascending"), ("timestamp", "ascending")]))
+        file_name = self._write_file("history", table)
+        for file_path in file_paths:
+            os.remove(file_path)
+
+        log.debug("Compacted %d history files, %d snapshots, into %s" % (len(file_paths), table.num_rows, file_name))
+
+    @staticmethod
+    def _history_files(history_dir):
+        return sorted(entry.path for entry in os.scandir(history_dir)
+                      if entry.is_file() and entry.name.endswith(".parquet") and not entry.name.startswith("."))
+
+    @staticmethod
+    def price_history(history_dir, auction_id):
+        # list of snapshot dicts of one auction ordered by time
+        if pyarrow is None:
+            raise RuntimeError("pyarrow is required to query the price history")
+        if not os.path.isdir(history_dir):
+            return list()
+
+        file_paths = SnapshotHistory._history_files(history_dir)
+        if not file_paths:
+            return list()
+
+        dataset = pyarrow.dataset.dataset(file_paths, format="parquet")
+        table = dataset.to_table(filter=pyarrow.dataset.field("id") == str(auction_id))
+        # one snapshot per run, a compaction which was interrupted can leave two
+        snapshots = {snapshot.get("timestamp"): snapshot for snapshot in table.to_pylist()}
+        return [snapshots[timestamp] for timestamp in sorted(snapshots.keys())]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: %s <history dir> <auction id>" % sys.argv[0])
+        sys.exit(1)
+
+    for snapshot in SnapshotHistory.price_history(sys.argv[1], sys.argv[2]):
+        print(' '.join("%s=%s" % (key, value) for key, value in snapshot.items()))
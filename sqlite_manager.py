@@ -0,0 +1,194 @@
+from util import Util
+import logutil
+import logging
+import sqlite3
+import math
+import csv
+import sys
+
+
+log = logging.getLogger("sqlite_manager")
+logutil.init_log(log, logging.DEBUG)
+
+_sql_types = {
+    str: "TEXT",
+    int: "INTEGER",
+    float: "REAL"
+}
+
+_python_types = {
+    "str": str,
+    "int": int,
+    "float": float
+}
+
+
+# Same interface as CsvManager, the rows are kept in a sqlite database instead of rewriting a csv file
+class SqliteManager:
+
+    def __init__(self, file_name, fields_type_tuples_list, identity_field, batch_size=500):
+        self.file_name = file_name
+        self.fields_to_type = {field_name: field_type
+                               for field_name, field_type in fields_type_tuples_list}
+        self.fields_names = [field[0] for field in fields_type_tuples_list]
+
+        self.identity_field = identity_field
+        self.updated_rows = set()
+
+        self.batch_size = batch_size
+        # identity value => row waiting for the next batch insert
+        self.pending_rows = dict()
+
+        self.connection = None
+
+    def _fix_row_types(self, row_dict):
+        for field_name, field_value in row_dict.items():
+            if field_value is not None and field_value != "":
+                row_dict[field_name] = self.fields_to_type.get(field_name)(field_value)
+
+    @staticmethod
+    def _sql_value(value):
+        # sqlite stores a NaN float (an unparsed price, see Util.str_to_float) as NULL, which reads
+        # back as None, so it is kept as the text "nan" and converted back by _fix_row_types; note
+        # that sqlite orders the text after every number
+        if isinstance(value, float) and math.isnan(value):
+            return "nan"
+        return value
+
+    def _fix_row_key_type(self, row_dict, key):
+        if row_dict.get(key) is not None:
+            row_dict[key] = self.fields_to_type.get(key)(row_dict.get(key))
+
+    def open_file(self, resume=False, done_ids=None):
+        # committed rows survive an interrupted run, nothing to recover when resuming
+        self.connection = sqlite3.connect(self.file_name)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+        columns = ', '.join(
+            '"{name}" {type}{key}'.format(
+                name=field_name,
+                type=_sql_types.get(self.fields_to_type.get(field_name), "TEXT"),
+                key=" PRIMARY KEY" if field_name == self.identity_field else "")
+            for field_name in self.fields_names)
+
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS auctions ({columns})".format(columns=columns))
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS parameters ("
+                "auction_id TEXT NOT NULL, name TEXT NOT NULL, value TEXT, PRIMARY KEY (auction_id, name))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS parameters_name ON parameters (name, value)")
+            # field order and types, so the csv export does not need the crawler definitions
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS fields (position INTEGER PRIMARY KEY, name TEXT, type TEXT)")
+            self.connection.execute("DELETE FROM fields")
+            self.connection.executemany(
+                "INSERT INTO fields (position, name, type) VALUES (?, ?, ?)",
+                [(position, field_name, self.fields_to_type.get(field_name).__name__)
+                 for position, field_name in enumerate(self.fields_names)])
+
+    def close_file(self):
+        if self.connection is not None:
+            self._flush()
+            self.connection.close()
+            self.connection = None
+
+    @staticmethod
+    def parse_parameters(parameters):
+        # "name:value|name:value" as built by the crawlers
+        parameters_dict = dict()
+        if parameters:
+            for parameter in parameters.split('|'):
+                name, _, value = parameter.partition(':')
+                if name:
+                    parameters_dict[name] = value
+        return parameters_dict
+
+    def _flush(self):
+        if not self.pending_rows:
+            return
+
+        rows = list(self.pending_rows.values())
+        ids = [(row.get(self.identity_field),) for row in rows]
+
+        placeholders = ', '.join('?' for _ in self.fields_names)
+        columns = ', '.join('"{name}"'.format(name=field_name) for field_name in self.fields_names)
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO auctions ({columns}) VALUES ({placeholders})".format(
+                    columns=columns, placeholders=placeholders),
+                [tuple(self._sql_value(row.get(field_name)) for field_name in self.fields_names) for row in rows])
+
+            self.connection.executemany("DELETE FROM parameters WHERE auction_id = ?", ids)
+            self.connection.executemany(
+                "INSERT INTO parameters (auction_id, name, value) VALUES (?, ?, ?)",
+                [(row.get(self.identity_field), name, value)
+                 for row in rows
+                 for name, value in self.parse_parameters(row.get("parameters")).items()])
+
+        self.pending_rows = dict()
+
+    def sync(self):
+        self._flush()
+
+    def get_row(self, row_dict):
+        self._fix_row_key_type(row_dict, self.identity_field)
+        identity = row_dict.get(self.identity_field)
+
+        if identity in self.pending_rows:
+            return self.pending_rows.get(identity)
+
+        cursor = self.connection.execute(
+            'SELECT * FROM auctions WHERE "{key}" = ?'.format(key=self.identity_field), (identity,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        row_dict = {column[0]: value for column, value in zip(cursor.description, row)}
+        self._fix_row_types(row_dict)
+        return row_dict
+
+    def update_row(self, row_dict):
+        if self.check_row_exist(row_dict):
+            self.updated_rows.add(row_dict.get(self.identity_field))
+        self._fix_row_types(row_dict)
+        self.pending_rows[row_dict.get(self.identity_field)] = row_dict
+
+        if len(self.pending_rows) >= self.batch_size:
+            self._flush()
+
+    def check_row_exist(self, row_dict):
+        return self.get_row(row_dict) is not None
+
+    @staticmethod
+    def export_csv(db_file_name, csv_file_name):
+        # writes the auctions in the csv layout of CsvManager, the values are converted to the field
+        # types the way CsvManager writes them (NaN prices as nan, not as an empty value)
+        connection = sqlite3.connect(db_file_name)
+        try:
+            fields = [(name, _python_types.get(type_name, str))
+                      for name, type_name in connection.execute("SELECT name, type FROM fields ORDER BY position")]
+            fields_names = [field_name for field_name, _ in fields]
+
+            with open(csv_file_name, "w", encoding="utf-8") as csv_file:
+                writer = csv.DictWriter(csv_file, fieldnames=fields_names,
+                                        delimiter=",", quoting=csv.QUOTE_NONNUMERIC)
+                writer.writeheader()
+
+                columns = ', '.join('"{name}"'.format(name=field_name) for field_name in fields_names)
+                num_rows = 0
+                for row in connection.execute("SELECT {columns} FROM auctions ORDER BY rowid".format(columns=columns)):
+                    writer.writerow({field_name: field_type(value) if value is not None and value != "" else value
+                                     for (field_name, field_type), value in zip(fields, row)})
+                    num_rows += 1
+        finally:
+            connection.close()
+
+        log.debug("Exported %d rows from %s to %s" % (num_rows, db_file_name, csv_file_name))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or not Util.check_file_exist(sys.argv[1]):
+        print("Usage: %s <sqlite file> <csv file>" % sys.argv[0])
+        sys.exit(1)
+    SqliteManager.export_csv(sys.argv[1], sys.argv[2])
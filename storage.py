@@ -0,0 +1,17 @@
+from csv_manager import CsvManager
+from sqlite_manager import SqliteManager
+import os
+
+
+class Storage:
+    # backend name => (manager class, file extension)
+    backends = {
+        "csv": (CsvManager, ".csv"),
+        "sqlite": (SqliteManager, ".sqlite")
+    }
+
+    @staticmethod
+    def create(backend, output_dir, name, fields_type_tuples_list, identity_field):
+        manager_class, extension = Storage.backends.get(backend)
+        file_name = os.path.join(output_dir, name + extension)
+        return manager_class(file_name, fields_type_tuples_list, identity_field)
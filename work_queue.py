@@ -0,0 +1,320 @@
+import contextlib
+import logutil
+import logging
+import sqlite3
+import json
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+log = logging.getLogger("work_queue")
+logutil.init_log(log, logging.DEBUG)
+
+
+# Tasks shared by the coordinator and the workers of a distributed crawl. Workers claim tasks with
+# a lease, a task whose lease expired (its worker died or hangs) is handed out again, a task failing
+# max_attempts times is given up. Completed tasks keep their result until the coordinator takes it.
+# Task states: pending -> leased -> done -> merged, or failed.
+# Lease expiry times are wall clock times, the clocks of the hosts have to be synchronized.
+class WorkQueue:
+
+    @staticmethod
+    def create(location, lease_time=120.0, max_attempts=3):
+        # redis://host:port/db or the path of a sqlite file on storage shared by the hosts
+        if location.startswith("redis://") or location.startswith("rediss://"):
+            return RedisWorkQueue(location, lease_time=lease_time, max_attempts=max_attempts)
+        return SqliteWorkQueue(location, lease_time=lease_time, max_attempts=max_attempts)
+
+
+class SqliteWorkQueue:
+
+    def __init__(self, file_path, lease_time=120.0, max_attempts=3):
+        self.file_path = file_path
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.connection = None
+
+    def open(self):
+        # transactions are started explicitly, the default rollback journal is kept because wal
+        # needs shared memory, which does not work on network file systems
+        self.connection = sqlite3.connect(self.file_path, timeout=60, isolation_level=None,
+                                          check_same_thread=False)
+        with self._transaction():
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, key TEXT NOT NULL, payload TEXT, "
+                "state TEXT NOT NULL DEFAULT 'pending', owner TEXT, lease_expires REAL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, result TEXT, UNIQUE (kind, key))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, id)")
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # takes the write lock up front, so two workers never claim the same task
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def clear(self):
+        with self._transaction():
+            self.connection.execute("DELETE FROM tasks")
+
+    def put_many(self, kind, tasks):
+        # tasks: (key, payload), a key already queued for the kind is ignored
+        with self._transaction():
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO tasks (kind, key, payload) VALUES (?, ?, ?)",
+                [(kind, key, json.dumps(payload)) for key, payload in tasks])
+
+    def _requeue_expired(self, now):
+        # expired leases go back to pending, or fail when they used up their attempts
+        self.connection.execute(
+            "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, owner = NULL "
+            "WHERE state = 'leased' AND lease_expires < ?", (self.max_attempts, now))
+
+    def requeue_expired(self):
+        # called by the coordinator too, the tasks of a dead worker are not left leased when
+        # no worker is claiming any more
+        with self._transaction():
+            self._requeue_expired(time.time())
+
+    def claim(self, owner, count=1):
+        now = time.time()
+        with self._transaction():
+            self._requeue_expired(now)
+            rows = self.connection.execute(
+                "SELECT id, kind, payload FROM tasks WHERE state = 'pending' ORDER BY id LIMIT ?",
+                (count,)).fetchall()
+            self.connection.executemany(
+                "UPDATE tasks SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE id = ?", [(owner, now + self.lease_time, task_id) for task_id, _, _ in rows])
+        return [(task_id, kind, json.loads(payload)) for task_id, kind, payload in rows]
+
+    def renew(self, owner, task_ids):
+        with self._transaction():
+            self.connection.executemany(
+                "UPDATE tasks SET lease_expires = ? WHERE id = ? AND owner = ? AND state = 'leased'",
+                [(time.time() + self.lease_time, task_id, owner) for task_id in task_ids])
+
+    def complete(self, task_id, result):
+        # a task finished after its lease expired still counts, the result is the same
+        with self._transaction():
+            self.connection.execute(
+                "UPDATE tasks SET state = 'done', owner = NULL, result = ? "
+                "WHERE id = ? AND state NOT IN ('done', 'merged')", (json.dumps(result), task_id))
+
+    def release(self, owner, task_id):
+        with self._transaction():
+            self.connection.execute(
+                "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, owner = NULL "
+                "WHERE id = ? AND owner = ? AND state = 'leased'", (self.max_attempts, task_id, owner))
+
+    def take_results(self, count=100):
+        # (task id, kind, payload, result) of completed tasks, each one is taken once
+        with self._transaction():
+            rows = self.connection.execute(
+                "SELECT id, kind, payload, result FROM tasks WHERE state = 'done' ORDER BY id LIMIT ?",
+                (count,)).fetchall()
+            self.connection.executemany(
+                "UPDATE tasks SET state = 'merged', result = NULL WHERE id = ?", [(row[0],) for row in rows])
+        return [(task_id, kind, json.loads(payload), json.loads(result))
+                for task_id, kind, payload, result in rows]
+
+    def counts(self):
+        # expired leases are counted as they will be requeued
+        states = {"pending": 0, "leased": 0, "done": 0, "merged": 0, "failed": 0}
+        states.update(self.connection.execute(
+            "SELECT CASE WHEN state = 'leased' AND lease_expires < ? "
+            "THEN CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END ELSE state END AS task_state, "
+            "COUNT(*) FROM tasks GROUP BY task_state", (time.time(), self.max_attempts)).fetchall())
+        return states
+
+
+# Same interface as SqliteWorkQueue on a redis server (or a compatible one), for workers on hosts
+# without a shared file system. Every state change is a lua script, so it is atomic.
+class RedisWorkQueue:
+
+    _put_script = """
+        if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+            return 0
+        end
+        local task_id = redis.call('INCR', KEYS[4])
+        redis.call('HSET', KEYS[1], ARGV[1], task_id)
+        redis.call('HSET', KEYS[2], task_id, ARGV[2])
+        redis.call('RPUSH', KEYS[3], task_id)
+        return task_id
+    """
+
+    # KEYS: pending, leases, attempts, owners, failed; ARGV: now, ..., max_attempts (4th)
+    _requeue_expired_script = """
+        local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+        for _, task_id in ipairs(expired) do
+            redis.call('ZREM', KEYS[2], task_id)
+            redis.call('HDEL', KEYS[4], task_id)
+            if tonumber(redis.call('HGET', KEYS[3], task_id) or '0') >= tonumber(ARGV[4]) then
+                redis.call('SADD', KEYS[5], task_id)
+            else
+                redis.call('RPUSH', KEYS[1], task_id)
+            end
+        end
+    """
+
+    _claim_script = _requeue_expired_script + """
+        local claimed = {}
+        for i = 1, tonumber(ARGV[3]) do
+            local task_id = redis.call('LPOP', KEYS[1])
+            if not task_id then
+                break
+            end
+            redis.call('ZADD', KEYS[2], ARGV[2], task_id)
+            redis.call('HINCRBY', KEYS[3], task_id, 1)
+            redis.call('HSET', KEYS[4], task_id, ARGV[5])
+            table.insert(claimed, task_id)
+        end
+        return claimed
+    """
+
+    _renew_script = """
+        for i = 2, #ARGV - 1 do
+            if redis.call('HGET', KEYS[2], ARGV[i]) == ARGV[1] then
+                redis.call('ZADD', KEYS[1], 'XX', ARGV[#ARGV], ARGV[i])
+            end
+        end
+        return 0
+    """
+
+    _complete_script = """
+        if redis.call('HSETNX', KEYS[3], ARGV[1], ARGV[2]) == 0 then
+            return 0
+        end
+        redis.call('ZREM', KEYS[1], ARGV[1])
+        redis.call('HDEL', KEYS[2], ARGV[1])
+        redis.call('LREM', KEYS[5], 0, ARGV[1])
+        redis.call('SREM', KEYS[6], ARGV[1])
+        redis.call('RPUSH', KEYS[4], ARGV[1])
+        return 1
+    """
+
+    _release_script = """
+        if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] or redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+            return 0
+        end
+        redis.call('HDEL', KEYS[2], ARGV[1])
+        if tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0') >= tonumber(ARGV[3]) then
+            redis.call('SADD', KEYS[5], ARGV[1])
+        else
+            redis.call('RPUSH', KEYS[4], ARGV[1])
+        end
+        return 1
+    """
+
+    def __init__(self, url, name="work_queue", lease_time=120.0, max_attempts=3):
+        if redis is None:
+            raise RuntimeError("redis is not installed, the redis work queue is not available")
+
+        self.url = url
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.keys = {key: "{name}:{key}".format(name=name, key=key) for key in
+                     ("ids", "next_id", "tasks", "pending", "leases", "owners", "attempts",
+                      "results", "done", "merged", "failed")}
+        self.client = None
+        self.scripts = dict()
+
+    def open(self):
+        self.client = redis.Redis.from_url(self.url, decode_responses=True)
+        for script_name in ("put", "requeue_expired", "claim", "renew", "complete", "release"):
+            self.scripts[script_name] = self.client.register_script(getattr(self, "_%s_script" % script_name))
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def _keys(self, *key_names):
+        return [self.keys.get(key_name) for key_name in key_names]
+
+    def clear(self):
+        self.client.delete(*self.keys.values())
+
+    def put_many(self, kind, tasks):
+        keys = self._keys("ids", "tasks", "pending", "next_id")
+        pipeline = self.client.pipeline(transaction=False)
+        for key, payload in tasks:
+            self.scripts.get("put")(keys=keys, client=pipeline,
+                                    args=["%s:%s" % (kind, key), json.dumps({"kind": kind, "payload": payload})])
+        pipeline.execute()
+
+    def requeue_expired(self):
+        self.scripts.get("requeue_expired")(
+            keys=self._keys("pending", "leases", "attempts", "owners", "failed"),
+            args=[time.time(), 0, 0, self.max_attempts])
+
+    def claim(self, owner, count=1):
+        now = time.time()
+        task_ids = self.scripts.get("claim")(
+            keys=self._keys("pending", "leases", "attempts", "owners", "failed"),
+            args=[now, now + self.lease_time, count, self.max_attempts, owner])
+        if not task_ids:
+            return list()
+        tasks = [json.loads(task) for task in self.client.hmget(self.keys.get("tasks"), task_ids)]
+        return [(int(task_id), task.get("kind"), task.get("payload")) for task_id, task in zip(task_ids, tasks)]
+
+    def renew(self, owner, task_ids):
+        if task_ids:
+            self.scripts.get("renew")(keys=self._keys("leases", "owners"),
+                                      args=[owner] + list(task_ids) + [time.time() + self.lease_time])
+
+    def complete(self, task_id, result):
+        self.scripts.get("complete")(keys=self._keys("leases", "owners", "results", "done", "pending", "failed"),
+                                     args=[task_id, json.dumps(result)])
+
+    def release(self, owner, task_id):
+        self.scripts.get("release")(keys=self._keys("leases", "owners", "attempts", "pending", "failed"),
+                                    args=[task_id, owner, self.max_attempts])
+
+    def take_results(self, count=100):
+        # a single coordinator takes the results, popping them needs no script
+        pipeline = self.client.pipeline()
+        pipeline.lrange(self.keys.get("done"), 0, count - 1)
+        pipeline.ltrim(self.keys.get("done"), count, -1)
+        task_ids, _ = pipeline.execute()
+        if not task_ids:
+            return list()
+        tasks = self.client.hmget(self.keys.get("tasks"), task_ids)
+        results = self.client.hmget(self.keys.get("results"), task_ids)
+        pipeline = self.client.pipeline()
+        # results are kept in the hash, so a late duplicate completion is still ignored
+        pipeline.hset(self.keys.get("results"), mapping={task_id: "null" for task_id in task_ids})
+        pipeline.incrby(self.keys.get("merged"), len(task_ids))
+        pipeline.execute()
+        taken = list()
+        for task_id, task, result in zip(task_ids, tasks, results):
+            task = json.loads(task)
+            taken.append((int(task_id), task.get("kind"), task.get("payload"), json.loads(result)))
+        return taken
+
+    def counts(self):
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.llen(self.keys.get("pending"))
+        pipeline.zcard(self.keys.get("leases"))
+        pipeline.zcount(self.keys.get("leases"), "-inf", time.time())
+        pipeline.llen(self.keys.get("done"))
+        pipeline.get(self.keys.get("merged"))
+        pipeline.scard(self.keys.get("failed"))
+        pending, leased, expired, done, merged, failed = pipeline.execute()
+        # expired leases are counted as pending, they are requeued by the next claim
+        return {"pending": pending + expired, "leased": leased - expired, "done": done,
+                "merged": int(merged or 0), "failed": failed}